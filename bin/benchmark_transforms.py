@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+import os,sys
+import time
+import json
+import itertools
+import tracemalloc
+
+import argparse
+
+import numpy
+
+# Add the local folder to the import path:
+network_dir = os.path.dirname(os.path.abspath(__file__))
+network_dir = os.path.dirname(network_dir)
+sys.path.insert(0,network_dir)
+
+from src.utils.larcvio import data_transforms
+
+'''
+Benchmark of the format conversions in data_transforms.
+
+Synthetic minibatches in the padded larcv format are generated with a
+realistic, long-tailed occupancy: the number of voxels per event follows a
+lognormal distribution with the requested mean fill fraction, clipped to
+MaxVoxels.  Each conversion is timed over a sweep of batch size, MaxVoxels
+and fill fraction.  The peak memory it allocates, and the number of blocks
+it retains (still allocated after the call: its outputs, or buffers it
+caches), are measured with tracemalloc (which sees numpy's buffers).
+Scratch buffers freed within the call show up in the peak, not the count.
+
+Regressions are judged on the fastest of the timed calls, which is the least
+sensitive to other load on the machine, and only count when they are beyond
+both the tolerance and the spread of the timings.
+
+Results can be stored as a baseline and later runs compared against it:
+
+    benchmark_transforms.py --save-baseline baseline.json
+    benchmark_transforms.py --compare baseline.json
+
+A reference baseline of the default sweep is kept next to this script, in
+benchmark_transforms_baseline.json, and --compare with no file checks
+against it.  Its timings are from one machine, so regenerate it with
+--save-baseline before comparing timings on another.
+'''
+
+# Smaller than the detector images, to keep the dense outputs of a
+# large minibatch in memory.  Only the dense conversions depend on these.
+dense_shape_2d = (512, 512)
+dense_shape_3d = (128, 128, 128)
+
+reference_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_transforms_baseline.json")
+
+def synthetic_occupancy(batch_size, max_voxels, fill_fraction, rng):
+    # Long tailed, like real events: most are small, a few fill the buffer.
+    sigma = 0.8
+    mean  = fill_fraction * max_voxels
+    counts = rng.lognormal(numpy.log(mean) - 0.5*sigma**2, sigma, size=batch_size)
+    return numpy.clip(counts.astype(numpy.int64), 1, max_voxels)
+
+def synthetic_batch(dimension, batch_size, max_voxels, fill_fraction, rng):
+
+    n_planes = 3 if dimension == 2 else 1
+    shape    = dense_shape_2d if dimension == 2 else dense_shape_3d
+
+    batch = numpy.full((batch_size, n_planes, max_voxels, dimension + 1), -999, dtype=numpy.float32)
+    for plane in range(n_planes):
+        counts = synthetic_occupancy(batch_size, max_voxels, fill_fraction, rng)
+        for i, n in enumerate(counts):
+            for d in range(dimension):
+                batch[i, plane, :n, d] = rng.integers(0, shape[d], size=n)
+            batch[i, plane, :n, dimension] = rng.random(size=n)
+
+    return batch
+
+def ragged_batch(batch):
+    # The same minibatch in the voxel cache format:
+    batch_index, plane_index, voxel_index = numpy.where(batch[..., -1] != -999)
+    voxels = batch[batch_index, plane_index, voxel_index]
+    counts = numpy.bincount(batch_index * batch.shape[1] + plane_index,
+        minlength=batch.shape[0] * batch.shape[1]).reshape(batch.shape[0], batch.shape[1])
+    return (voxels[:, :-1].astype(numpy.int16), voxels[:, -1].copy(), counts)
+
+# name : (dimension, function of the synthetic batch)
+transforms = {
+    'larcvsparse_to_dense_2d'      : (2, lambda b : data_transforms.larcvsparse_to_dense_2d(b, dense_shape_2d)),
+    'larcvsparse_to_scnsparse_2d'  : (2, data_transforms.larcvsparse_to_scnsparse_2d),
+    'ragged_to_scnsparse_2d'       : (2, data_transforms.ragged_to_scnsparse_2d),
+    'larcvsparse_to_dense_3d'      : (3, lambda b : data_transforms.larcvsparse_to_dense_3d(b[:,0], dense_shape_3d)),
+    'larcvsparse_to_scnsparse_3d'  : (3, data_transforms.larcvsparse_to_scnsparse_3d),
+    'larcvsparse_to_scnsparse_3d_reused' : (3, lambda b, c=data_transforms.sparse_compactor() : data_transforms.larcvsparse_to_scnsparse_3d(b, c)),
+    'ragged_to_scnsparse_3d'       : (3, data_transforms.ragged_to_scnsparse_3d),
+    'larcvsparse_to_pointcloud_3d' : (3, data_transforms.larcvsparse_to_pointcloud_3d),
+    'ragged_to_pointcloud_3d'      : (3, data_transforms.ragged_to_pointcloud_3d),
+}
+
+def measure(function, batch, repeats):
+
+    # Warm up, then time:
+    function(batch)
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(batch)
+        times.append(time.perf_counter() - start)
+
+    # Peak memory allocated during one call, and the blocks still allocated
+    # after it (with the output kept alive), from a snapshot diff.  Blocks
+    # allocated and freed during the call aren't counted:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    baseline, _ = tracemalloc.get_traced_memory()
+    output = function(batch)
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del output
+
+    # Leaving out the snapshots' own allocations:
+    exclude = [ tracemalloc.Filter(False, tracemalloc.__file__) ]
+    diff = after.filter_traces(exclude).compare_to(before.filter_traces(exclude), 'lineno')
+    blocks = sum(stat.count_diff for stat in diff if stat.count_diff > 0)
+
+    times = numpy.asarray(times)
+    return {
+        'time_median'      : float(numpy.median(times)),
+        'time_min'         : float(numpy.min(times)),
+        # Median absolute deviation, a robust measure of the timing noise:
+        'time_mad'         : float(numpy.median(numpy.abs(times - numpy.median(times)))),
+        'peak_bytes'       : int(peak - baseline),
+        'retained_blocks'  : int(blocks),
+    }
+
+def run(args):
+
+    results = {}
+    for name in args.transforms:
+        dimension, function = transforms[name]
+        for batch_size, max_voxels, fill in itertools.product(args.batch_sizes, args.max_voxels, args.fill_fractions):
+            if dimension == 2 and max_voxels > 20000:
+                continue
+            # Seeded per configuration, so any subset of the sweep sees the same data:
+            rng = numpy.random.default_rng([args.seed, dimension, batch_size, max_voxels, int(fill * 1e6)])
+            batch = synthetic_batch(dimension, batch_size, max_voxels, fill, rng)
+            if name.startswith('ragged'):
+                batch = ragged_batch(batch)
+
+            key = f"{name}/B{batch_size}/V{max_voxels}/f{fill}"
+            results[key] = measure(function, batch, args.repeats)
+            # Peak memory relative to the input is a proxy for temporaries:
+            input_bytes = sum(b.nbytes for b in batch if hasattr(b, 'nbytes')) if isinstance(batch, tuple) else batch.nbytes
+            results[key]['peak_over_input'] = results[key]['peak_bytes'] / input_bytes
+
+            print("{key:60} {t:9.3f} ms  {p:9.1f} MB  ({r:.2f}x input)  {n:6d} blocks retained".format(
+                key = key,
+                t   = 1000*results[key]['time_min'],
+                p   = results[key]['peak_bytes'] / 1024**2,
+                r   = results[key]['peak_over_input'],
+                n   = results[key]['retained_blocks']))
+
+    return results
+
+def compare(results, baseline, tolerance):
+
+    regressions = []
+    for key in results:
+        if key not in baseline:
+            continue
+        for metric in ['time_min', 'peak_bytes', 'retained_blocks']:
+            if metric not in baseline[key]:
+                continue
+            old = baseline[key][metric]
+            new = results[key][metric]
+            threshold = old * (1 + tolerance)
+            if metric == 'time_min':
+                # Slowdowns within a few times the timing noise of either run aren't real:
+                threshold += 3 * max(baseline[key].get('time_mad', 0.), results[key]['time_mad'])
+            if old > 0 and new > threshold:
+                regressions.append(f"{key} {metric}: {old:.4g} -> {new:.4g} ({new/old:.2f}x)")
+
+    for r in regressions:
+        print("REGRESSION", r)
+    if len(regressions) == 0:
+        print("No regressions beyond {:.0%}".format(tolerance))
+
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description     = 'Benchmark the data_transforms conversions',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--transforms',
+        nargs   = '+',
+        choices = list(transforms.keys()),
+        default = list(transforms.keys()),
+        help    = "Conversions to benchmark")
+    parser.add_argument('--batch-sizes',
+        type    = int,
+        nargs   = '+',
+        default = [16, 64],
+        help    = "Minibatch sizes to sweep")
+    parser.add_argument('--max-voxels',
+        type    = int,
+        nargs   = '+',
+        default = [16000, 20000],
+        help    = "Padded voxels per event to sweep")
+    parser.add_argument('--fill-fractions',
+        type    = float,
+        nargs   = '+',
+        default = [0.05, 0.2],
+        help    = "Mean fraction of MaxVoxels filled per event")
+    parser.add_argument('--repeats',
+        type    = int,
+        default = 20,
+        help    = "Timed calls per configuration")
+    parser.add_argument('--seed',
+        type    = int,
+        default = 0,
+        help    = "Seed for the synthetic data")
+    parser.add_argument('--save-baseline',
+        type    = str,
+        default = None,
+        help    = "Store the results as a baseline in this json file")
+    parser.add_argument('--compare',
+        type    = str,
+        nargs   = '?',
+        const   = reference_baseline,
+        default = None,
+        help    = "Compare the results to the baseline in this json file (the reference baseline if no file is given)")
+    parser.add_argument('--tolerance',
+        type    = float,
+        default = 0.2,
+        help    = "Relative slowdown or memory growth reported as a regression")
+
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as _f:
+            json.dump(results, _f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as _f:
+            baseline = json.load(_f)
+        if len(compare(results, baseline, args.tolerance)) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
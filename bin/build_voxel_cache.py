@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+import os,sys
+import time
+
+import argparse
+
+import numpy
+
+# Add the local folder to the import path:
+network_dir = os.path.dirname(os.path.abspath(__file__))
+network_dir = os.path.dirname(network_dir)
+sys.path.insert(0,network_dir)
+
+from src.utils.larcvio import larcv_fetcher
+from src.utils.larcvio import voxel_cache
+
+'''
+One time conversion of a larcv file into a compact voxel cache.
+
+The cache directory can be passed anywhere a larcv file is accepted (--file,
+--aux-file), and the fetcher will serve batches from it directly.
+'''
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description     = 'Convert a larcv file into a ragged voxel cache',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-f','--file',
+        type     = str,
+        nargs    = '+',
+        required = True,
+        help     = "Input larcv file(s), globs or directories, cached in order as one sample")
+    parser.add_argument('-o','--output',
+        type     = str,
+        required = True,
+        help     = "Output cache directory (must not exist)")
+    parser.add_argument('--input-dimension',
+        type    = int,
+        default = 3,
+        choices = [2, 3],
+        help    = "Dimensionality of data to use")
+    parser.add_argument('--label-mode',
+        type    = str,
+        choices = ['split', 'all'],
+        default = 'split',
+        help    = "Labels to store: split labels (multiple classifiers) or all in one" )
+    parser.add_argument('--value-dtype',
+        type    = str,
+        choices = ['float32', 'float16'],
+        default = 'float32',
+        help    = "Storage precision of the voxel values")
+    parser.add_argument('-mb','--minibatch-size',
+        type    = int,
+        default = 64,
+        help    = "Number of events to read from larcv at once")
+
+    args = parser.parse_args()
+
+    fetcher = larcv_fetcher.larcv_fetcher(
+        mode            = "inference",
+        distributed     = False,
+        image_mode      = "sparse",
+        label_mode      = args.label_mode,
+        input_dimension = args.input_dimension,
+    )
+
+    n_events = fetcher.prepare_sample(
+        name        = "primary",
+        input_file  = args.file,
+        batch_size  = args.minibatch_size)
+
+    cache = voxel_cache.writer(args.output, dimension=args.input_dimension, value_dtype=args.value_dtype)
+
+    start = time.time()
+    n_written = 0
+    while n_written < n_events:
+        minibatch_data = fetcher.fetch_raw_batch("primary", pop=True)
+        # larcv wraps around at the end of the file, so trim the last batch:
+        n_batch = min(args.minibatch_size, n_events - n_written)
+        cache.append(minibatch_data, n_events=n_batch)
+        n_written += n_batch
+
+        if (n_written // args.minibatch_size) % 100 == 0:
+            print(f"Converted {n_written} of {n_events} events ({time.time() - start:.1f}s)")
+
+    cache.finalize()
+
+    print(f"Wrote {n_written} events to {args.output} in {time.time() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
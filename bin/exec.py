@@ -91,11 +91,27 @@ The most commonly used commands are:
             type    = float,
             default = 0.0,
             help    = "Weight decay strength")
+        self.parser.add_argument('--accumulation-steps',
+            type    = int,
+            default = 1,
+            help    = "Number of minibatches to accumulate gradients over per optimizer step")
+        self.parser.add_argument('--shard-optimizer-state',
+            action  = 'store_true',
+            default = False,
+            help    = "In distributed training, write the optimizer state in checkpoints sharded by rank")
+        self.parser.add_argument('--eval-iteration',
+            type    = int,
+            default = -1,
+            help    = "Period (in steps) to evaluate on the whole aux file, replacing single minibatch validation (-1 disables)")
         self.parser.add_argument("--loss-mode",
             type    = str,
             default = 'mean',
             choices = ['mean', 'focal'],
             help    = "Configure the loss averaging scheme between batches.")
+        self.parser.add_argument('--balance-loss',
+            action  = 'store_true',
+            default = False,
+            help    = "Weight the loss of each class by its inverse frequency in the training file(s)")
 
 
 
@@ -166,6 +182,10 @@ The most commonly used commands are:
 
     def make_trainer(self):
 
+        # -f appends, so the default has to be filled in after parsing:
+        if self.args.file is None:
+            self.args.file = [pathlib.Path("/not/a/file")]
+
         if self.args.mode == "iotest":
             from src.utils import iocore
 
@@ -180,6 +200,12 @@ The most commonly used commands are:
                 import horovod.torch as hvd
                 hvd.init()
                 os.environ['CUDA_VISIBLE_DEVICES'] = str(hvd.local_rank())
+            elif self.args.compute_mode == "GPU":
+                # One GPU per process, picked by the node local rank from torchrun or MPI:
+                for key in ['LOCAL_RANK', 'OMPI_COMM_WORLD_LOCAL_RANK', 'MPI_LOCALRANKID', 'PMI_LOCAL_RANK']:
+                    if key in os.environ:
+                        os.environ['CUDA_VISIBLE_DEVICES'] = os.environ[key]
+                        break
 
             from src.utils import distributed_trainer
 
@@ -189,7 +215,38 @@ The most commonly used commands are:
             self.trainer = torch_trainer.torch_trainer(self.args)
 
     def inference(self):
-        pass
+        self.parser = argparse.ArgumentParser(
+            description     = 'Run Network Inference',
+            formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+        self.add_io_arguments(self.parser)
+        self.add_core_configuration(self.parser)
+
+        self.parser.add_argument('-cd','--checkpoint-directory',
+            default = None,
+            help    = 'Prefix (directory + file prefix) for snapshots of weights')
+        self.parser.add_argument('--n-entries',
+            type    = int,
+            default = -1,
+            help    = "Number of entries to process after --start-index (-1 for all)")
+        # Inference covers the whole entry range, unless told to stop early:
+        self.parser.set_defaults(iterations = -1)
+
+        self.add_network_parsers(self.parser)
+
+        self.args = self.parser.parse_args(sys.argv[2:])
+        self.args.training = False
+        self.args.mode = "inference"
+        # Losses are only computed to report metrics when labels are present:
+        self.args.loss_mode = "mean"
+
+        self.make_trainer()
+
+        self.trainer.print("Running Inference")
+        self.trainer.print(self.__str__())
+
+        self.trainer.initialize()
+        self.trainer.batch_process()
 
 
     def __str__(self):
@@ -210,8 +267,7 @@ The most commonly used commands are:
         return s
 
     def stop(self):
-        if not self.args.distributed:
-            self.trainer.stop()
+        self.trainer.stop()
 
 
 
@@ -232,12 +288,41 @@ The most commonly used commands are:
             default = 'horovod',
             choices = ['horovod', 'DDP'],
             help    = "Use horovod or torch's native DDP for data-parallel training.")
+        parser.add_argument('--ddp-rendezvous',
+            type    = str,
+            default = 'env',
+            help    = "DDP rendezvous: 'env' for torchrun environment variables, or the path of a file all ranks can see")
+        parser.add_argument('--ddp-bucket-mb',
+            type    = float,
+            default = 25.,
+            help    = "Size of the DDP gradient buckets in MB, smaller buckets start reducing sooner")
 
         parser.add_argument('-m','--compute-mode',
             type    = str,
             choices = ['CPU','GPU'],
             default = 'CPU',
             help    = "Selection of compute device, CPU or GPU ")
+        parser.add_argument('--pin-memory',
+            action  = 'store_true',
+            default = False,
+            help    = "Stage host to device copies through reusable pinned buffers (GPU only)")
+        parser.add_argument('--intra-op-threads',
+            type    = int,
+            default = 0,
+            help    = "Number of torch intra-op threads (0 leaves the torch default)")
+        parser.add_argument('--precision',
+            type    = str,
+            choices = ['fp32', 'bf16', 'fp16'],
+            default = 'fp32',
+            help    = "Compute precision of the forward pass and loss, with autocast for bf16 and fp16")
+        parser.add_argument('--profile-start',
+            type    = int,
+            default = -1,
+            help    = "Global step to start a torch.profiler trace at (-1 disables tracing)")
+        parser.add_argument('--profile-steps',
+            type    = int,
+            default = 5,
+            help    = "Number of steps to trace with torch.profiler")
         parser.add_argument('-im','--image-mode',
             type    = str,
             choices = ['dense', 'sparse', 'graph'],
@@ -255,8 +340,9 @@ The most commonly used commands are:
         # IO PARAMETERS FOR INPUT:
         parser.add_argument('-f','--file',
             type    = pathlib.Path,
-            default = "/not/a/file",
-            help    = "IO Input File")
+            action  = 'append',
+            default = None,
+            help    = "IO Input File: a file, glob or directory of .h5 files (repeat -f for several)")
         parser.add_argument('--input-dimension',
             type    = int,
             default = 3,
@@ -278,6 +364,22 @@ The most commonly used commands are:
             default = 2,
             help    = "Number of images in the minibatch size")
 
+        parser.add_argument('--io-backend',
+            type    = str,
+            choices = ['larcv', 'mmap'],
+            default = 'larcv',
+            help    = "Read larcv files, or memory map voxel caches made with bin/build_voxel_cache.py")
+
+        parser.add_argument('--prefetch-depth',
+            type    = int,
+            default = 0,
+            help    = "Number of converted minibatches to prepare ahead in a background thread (0 disables)")
+
+        parser.add_argument('--voxel-budget',
+            type    = int,
+            default = 0,
+            help    = "Training only: pack minibatches up to this many voxels (at most --minibatch-size events), needs the mmap backend (0 disables)")
+
         # IO PARAMETERS FOR AUX INPUT:
         parser.add_argument('--aux-file',
             type    = pathlib.Path,
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import os,sys
+import time
+import math
+import subprocess
+
+import argparse
+
+import h5py
+
+# Add the local folder to the import path:
+network_dir = os.path.dirname(os.path.abspath(__file__))
+network_dir = os.path.dirname(network_dir)
+sys.path.insert(0,network_dir)
+
+from src.utils import inference_writer
+from src.utils.larcvio.larcv_fetcher import resolve_input_files, count_entries
+
+'''
+Run inference on one node with several worker processes.
+
+The input file is split into contiguous entry ranges, one per worker.  Each
+worker is an `exec.py inference` process with its own --start-index,
+--n-entries and torch thread count, writing a partial output file.  When all
+workers finish, the partial outputs are merged in entry order.
+
+Everything after `--` is passed on to exec.py inference, e.g.:
+
+    inference_launcher.py -n 8 -f in.h5 --aux-file out.h5 -- -mb 256 -cd ckpt/ sparseresnet3d
+'''
+
+def main():
+
+    argv = sys.argv[1:]
+    if '--' in argv:
+        split = argv.index('--')
+        argv, passthrough = argv[:split], argv[split + 1:]
+    else:
+        passthrough = []
+
+    parser = argparse.ArgumentParser(
+        description     = 'Shard inference over several processes on one node',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-f','--file',
+        type     = str,
+        nargs    = '+',
+        required = True,
+        help     = "IO Input File(s): files, globs or directories of .h5 files")
+    parser.add_argument('--aux-file',
+        type     = str,
+        required = True,
+        help     = "Merged output file")
+    parser.add_argument('-n','--n-shards',
+        type    = int,
+        default = 4,
+        help    = "Number of worker processes")
+    parser.add_argument('--threads-per-shard',
+        type    = int,
+        default = 0,
+        help    = "Torch intra-op threads per worker (0 divides the cores evenly)")
+    parser.add_argument('--keep-shards',
+        action  = 'store_true',
+        default = False,
+        help    = "Don't delete the per-shard outputs after merging")
+
+    args = parser.parse_args(argv)
+
+    # Entry ranges run over the files in order, so expand any globs once here:
+    input_files = resolve_input_files(args.file)
+    n_entries   = count_entries(input_files)
+    n_shards  = max(1, min(args.n_shards, n_entries))
+
+    threads = args.threads_per_shard
+    if threads <= 0:
+        threads = max(1, os.cpu_count() // n_shards)
+
+    # Contiguous entry ranges, as even as possible:
+    boundaries = [ (i * n_entries) // n_shards for i in range(n_shards + 1) ]
+
+    exec_path = os.path.join(network_dir, "bin", "exec.py")
+
+    # The minibatch size is passed through to exec.py, and sets how many
+    # iterations each shard needs to cover its range:
+    minibatch_parser = argparse.ArgumentParser(add_help=False)
+    minibatch_parser.add_argument('-mb','--minibatch-size', type=int, default=2) # exec.py's default
+    minibatch_size = minibatch_parser.parse_known_args(passthrough)[0].minibatch_size
+
+    processes   = []
+    shard_files = []
+    for i in range(n_shards):
+        start  = boundaries[i]
+        length = boundaries[i+1] - start
+
+        shard_file = f"{args.aux_file}.shard{i}"
+        shard_files.append(shard_file)
+
+        # The network subcommand has to come last, so the shard options go first:
+        command = [sys.executable, exec_path, "inference",
+            *[ arg for f in input_files for arg in ("--file", f) ],
+            "--aux-file",         shard_file,
+            "--start-index",      str(start),
+            "--n-entries",        str(length),
+            "--iterations",       str(int(math.ceil(length / minibatch_size))),
+            "--intra-op-threads", str(threads),
+        ] + passthrough
+
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = str(threads)
+        env['MKL_NUM_THREADS'] = str(threads)
+
+        print(f"Shard {i}: entries {start} to {start + length}")
+        processes.append(subprocess.Popen(command, env=env))
+
+    start_time = time.time()
+    failed = [ i for i, p in enumerate(processes) if p.wait() != 0 ]
+    if len(failed) > 0:
+        raise Exception(f"Inference shards {failed} failed, not merging")
+
+    # A shard that exits cleanly but wrote too few events would leave a hole in the merged output:
+    for i, shard_file in enumerate(shard_files):
+        expected = boundaries[i+1] - boundaries[i]
+        with h5py.File(shard_file, 'r') as _f:
+            written = _f['entries'].shape[0] if 'entries' in _f else 0
+        if written != expected:
+            raise Exception(f"Shard {i} wrote {written} events for entries {boundaries[i]} to {boundaries[i+1]}, not merging")
+
+    inference_writer.merge(args.aux_file, shard_files)
+
+    if not args.keep_shards:
+        for shard_file in shard_files:
+            os.remove(shard_file)
+
+    elapsed = time.time() - start_time
+    print(f"Processed {n_entries} entries with {n_shards} shards in {elapsed:.1f}s ({n_entries / elapsed:.1f} entries / s)")
+
+
+if __name__ == '__main__':
+    main()
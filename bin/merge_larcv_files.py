@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import os,sys
+import time
+
+import argparse
+
+# Add the local folder to the import path:
+network_dir = os.path.dirname(os.path.abspath(__file__))
+network_dir = os.path.dirname(network_dir)
+sys.path.insert(0,network_dir)
+
+from src.utils.larcvio import file_merge
+from src.utils.larcvio.larcv_fetcher import resolve_input_files
+
+'''
+Merge a sample of larcv files into train and test files, in parallel.
+
+The merges run as a k-ary tree in a process pool (see file_merge), and each
+event goes to train or test by a hash of its event ID, so the split is the
+same however the sample is divided into files.  This replaces the serial
+file_premerge.py / file_merge.py pair, e.g.:
+
+    merge_larcv_files.py -f 'original/merged_sample_*.h5' -o merged/merged_sample_all --test-fraction 0.2
+
+writes merged/merged_sample_all_train.h5 and merged/merged_sample_all_test.h5.
+'''
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description     = 'Merge larcv files into train and test files with a parallel tree of merges',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-f','--file',
+        type     = str,
+        nargs    = '+',
+        required = True,
+        help     = "Input larcv file(s), globs or directories")
+    parser.add_argument('-o','--output',
+        type     = str,
+        required = True,
+        help     = "Output prefix, _train.h5 and _test.h5 are appended (or .h5 with no test split)")
+    parser.add_argument('--test-fraction',
+        type    = float,
+        default = 0.2,
+        help    = "Fraction of events in the test file, 0 merges everything into one file")
+    parser.add_argument('--seed',
+        type    = int,
+        default = 0,
+        help    = "Seed of the event ID hash that assigns events to train or test")
+    parser.add_argument('-k','--fan-in',
+        type    = int,
+        default = 8,
+        help    = "Number of files merged together at each node of the tree")
+    parser.add_argument('-n','--n-workers',
+        type    = int,
+        default = os.cpu_count(),
+        help    = "Number of merges to run at once")
+    parser.add_argument('--retries',
+        type    = int,
+        default = 2,
+        help    = "Number of times to retry a failed merge")
+    parser.add_argument('--tmp-dir',
+        type    = str,
+        default = None,
+        help    = "Directory for the intermediate files (defaults to the output directory)")
+    parser.add_argument('--keep-intermediate',
+        action  = 'store_true',
+        default = False,
+        help    = "Don't delete the intermediate files of the tree")
+
+    args = parser.parse_args()
+
+    input_files = resolve_input_files(args.file)
+
+    if args.test_fraction > 0:
+        outputs   = [args.output + "_train.h5", args.output + "_test.h5"]
+        fractions = [1. - args.test_fraction, args.test_fraction]
+    else:
+        outputs   = [args.output + ".h5"]
+        fractions = None
+
+    print(f"Merging {len(input_files)} files into {', '.join(outputs)}")
+
+    start = time.time()
+    n_entries = file_merge.tree_merge(
+        input_files       = input_files,
+        outputs           = outputs,
+        fractions         = fractions,
+        fan_in            = args.fan_in,
+        n_workers         = args.n_workers,
+        tmp_dir           = args.tmp_dir,
+        seed              = args.seed,
+        retries           = args.retries,
+        keep_intermediate = args.keep_intermediate)
+
+    elapsed = time.time() - start
+    input_mb = sum(os.path.getsize(f) for f in input_files) / 2.**20
+    for output, n in zip(outputs, n_entries):
+        print(f"{output}: {n} entries")
+    print(f"Merged {input_mb:.1f} MB in {elapsed:.1f}s ({input_mb / elapsed:.1f} MB/s)")
+
+
+if __name__ == '__main__':
+    main()
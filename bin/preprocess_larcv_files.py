@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+import os,sys
+import re
+import json
+import time
+import concurrent.futures
+
+import argparse
+
+# Add the local folder to the import path:
+network_dir = os.path.dirname(os.path.abspath(__file__))
+network_dir = os.path.dirname(network_dir)
+sys.path.insert(0,network_dir)
+
+from src.utils.larcvio import file_merge
+from src.utils.larcvio.larcv_fetcher import resolve_input_files, count_entries
+
+'''
+Run a larcv ProcessDriver configuration (like the ones in larcv_scripts/)
+over many files at once.
+
+The inputs are split into work units, whole files or entry ranges of
+--entries-per-unit, and each unit runs in its own ProcessDriver in a process
+pool, writing a temporary output.  A JSON manifest records every unit and
+its status, so a rerun with the same manifest only redoes the units that
+didn't finish.  At the end, the unit outputs are merged in order with the
+parallel tree merge of merge_larcv_files.py.
+
+Parameters of the configuration can be changed without editing it, with
+--set Block.Param=value, e.g.:
+
+    preprocess_larcv_files.py -c larcv_scripts/preprocess_fullres_3D.cfg -f 'raw/*.h5' -o out_3d.h5 \\
+        --set Cluster3DThreshold.Threshold=0.2
+'''
+
+
+def override_config(config, overrides):
+    '''Replace parameters of a larcv configuration string
+
+    Each override is (path, value), where path is the dot separated names of
+    the enclosing blocks and the parameter, like Cluster3DThreshold.Threshold.
+    The enclosing blocks only have to be the innermost ones.
+    '''
+
+    lines = config.split('\n')
+    for path, value in overrides:
+        names = path.split('.')
+        blocks, param = names[:-1], names[-1]
+
+        stack = []
+        found = False
+        for i, line in enumerate(lines):
+            block = re.match(r'\s*(\w+)\s*:\s*{(\s*})?', line)
+            if block is not None:
+                # Empty blocks, like ProcessList: {}, open and close on one line:
+                if block.group(2) is None:
+                    stack.append(block.group(1))
+                continue
+            if re.match(r'\s*}', line):
+                stack.pop()
+                continue
+            match = re.match(r'(\s*)' + param + r'(\s*):', line)
+            if match is not None and stack[len(stack) - len(blocks):] == blocks:
+                lines[i] = f"{match.group(1)}{param}{match.group(2)}: {value}"
+                found = True
+                break
+
+        if not found:
+            raise Exception(f"No parameter {path} in the configuration")
+
+    return '\n'.join(lines)
+
+
+def work_units(input_files, entries_per_unit):
+    '''Split the input into (file, start entry, number of entries) units'''
+
+    units = []
+    for f in input_files:
+        if entries_per_unit <= 0:
+            units.append((f, 0, 0))
+            continue
+        n_entries = count_entries(f)
+        for start in range(0, n_entries, entries_per_unit):
+            units.append((f, start, min(entries_per_unit, n_entries - start)))
+    return units
+
+
+def run_unit(config_file, input_file, start, n_entries, output_file):
+    '''Run the ProcessDriver over one unit, in a worker process'''
+
+    from larcv import larcv
+
+    start_time = time.time()
+
+    driver = larcv.ProcessDriver('ProcessDriver')
+    driver.configure(config_file)
+    driver.override_input_file([input_file])
+    driver.override_output_file(output_file + ".tmp")
+    driver.initialize()
+    # 0 entries processes the whole file:
+    driver.batch_process(start, n_entries)
+    driver.finalize()
+
+    os.replace(output_file + ".tmp", output_file)
+
+    return time.time() - start_time
+
+
+def write_manifest(manifest_file, manifest):
+    with open(manifest_file + ".tmp", 'w') as _f:
+        json.dump(manifest, _f, indent=2)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description     = 'Run a larcv ProcessDriver configuration over many files in parallel',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-c','--config',
+        type     = str,
+        required = True,
+        help     = "ProcessDriver configuration, like larcv_scripts/preprocess_fullres_3D.cfg")
+    parser.add_argument('-f','--file',
+        type     = str,
+        nargs    = '+',
+        required = True,
+        help     = "Input larcv file(s), globs or directories")
+    parser.add_argument('-o','--output',
+        type     = str,
+        required = True,
+        help     = "Merged output file (with --test-fraction, the prefix of _train.h5 and _test.h5)")
+    parser.add_argument('--set',
+        type    = str,
+        nargs   = '*',
+        default = [],
+        help    = "Configuration overrides, as Block.Param=value")
+    parser.add_argument('--entries-per-unit',
+        type    = int,
+        default = 0,
+        help    = "Entries per work unit, 0 makes every file one unit (use 0 with RandomAccess configs)")
+    parser.add_argument('-n','--n-workers',
+        type    = int,
+        default = os.cpu_count(),
+        help    = "Number of ProcessDrivers to run at once")
+    parser.add_argument('--work-dir',
+        type    = str,
+        default = None,
+        help    = "Directory for the unit outputs and the manifest (defaults to <output>.work)")
+    parser.add_argument('--test-fraction',
+        type    = float,
+        default = 0.,
+        help    = "Fraction of events to merge into a test file, by event ID hash")
+    parser.add_argument('-k','--fan-in',
+        type    = int,
+        default = 8,
+        help    = "Number of files merged together at each node of the merge tree")
+    parser.add_argument('--no-merge',
+        action  = 'store_true',
+        default = False,
+        help    = "Stop after processing, leaving the unit outputs and the manifest")
+
+    args = parser.parse_args()
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = args.output + ".work"
+    os.makedirs(work_dir, exist_ok=True)
+
+    # Apply the overrides once, and give every worker the same configuration:
+    with open(args.config, 'r') as _f:
+        config = _f.read()
+    overrides = [ tuple(o.split('=', 1)) for o in args.set ]
+    config = override_config(config, overrides)
+    config_file = os.path.join(work_dir, os.path.basename(args.config))
+    with open(config_file, 'w') as _f:
+        _f.write(config)
+
+    input_files = resolve_input_files(args.file)
+    units = work_units(input_files, args.entries_per_unit)
+
+    # Pick up a manifest from an earlier run with the same units:
+    manifest_file = os.path.join(work_dir, "manifest.json")
+    manifest = None
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, 'r') as _f:
+            manifest = json.load(_f)
+        previous = [ (u['input_file'], u['start'], u['n_entries']) for u in manifest['units'] ]
+        if manifest['config'] != config or previous != units:
+            print("The configuration or the inputs changed since the last run, starting over")
+            manifest = None
+
+    if manifest is None:
+        manifest = {
+            'config' : config,
+            'units'  : [ {
+                'input_file'  : f,
+                'start'       : start,
+                'n_entries'   : n,
+                'output_file' : os.path.join(work_dir, f"unit_{i}.h5"),
+                'status'      : 'pending',
+            } for i, (f, start, n) in enumerate(units) ],
+        }
+    write_manifest(manifest_file, manifest)
+
+    todo = [ u for u in manifest['units'] if u['status'] != 'done' or not os.path.isfile(u['output_file']) ]
+    print(f"Processing {len(todo)} of {len(units)} units from {len(input_files)} files with {args.n_workers} workers")
+
+    start_time = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as pool:
+        futures = {}
+        for unit in todo:
+            future = pool.submit(run_unit, config_file,
+                unit['input_file'], unit['start'], unit['n_entries'], unit['output_file'])
+            futures[future] = unit
+
+        for future in concurrent.futures.as_completed(futures):
+            unit = futures[future]
+            try:
+                unit['elapsed'] = future.result()
+                unit['status']  = 'done'
+                print(f"Processed {unit['input_file']} from entry {unit['start']} in {unit['elapsed']:.1f}s")
+            except Exception as e:
+                unit['status'] = 'failed'
+                unit['error']  = str(e)
+                print(f"Processing {unit['input_file']} from entry {unit['start']} failed: {e}")
+            write_manifest(manifest_file, manifest)
+
+    failed = [ u for u in manifest['units'] if u['status'] != 'done' ]
+    print(f"Processing took {time.time() - start_time:.1f}s")
+    if len(failed) > 0:
+        raise Exception(f"{len(failed)} units failed, see {manifest_file}, and rerun to retry them")
+
+    if args.no_merge:
+        return
+
+    if args.test_fraction > 0:
+        outputs   = [args.output.replace('.h5', '') + "_train.h5", args.output.replace('.h5', '') + "_test.h5"]
+        fractions = [1. - args.test_fraction, args.test_fraction]
+    else:
+        outputs   = [args.output]
+        fractions = None
+
+    file_merge.tree_merge(
+        input_files = [ u['output_file'] for u in manifest['units'] ],
+        outputs     = outputs,
+        fractions   = fractions,
+        fan_in      = args.fan_in,
+        n_workers   = args.n_workers,
+        tmp_dir     = work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+import os,sys
+import time
+import concurrent.futures
+
+import argparse
+
+import numpy
+import h5py
+
+# Add the local folder to the import path:
+network_dir = os.path.dirname(os.path.abspath(__file__))
+network_dir = os.path.dirname(network_dir)
+sys.path.insert(0,network_dir)
+
+from src.utils.larcvio.larcv_fetcher import resolve_input_files
+
+'''
+Per plane voxel counts of a sparse tensor product, over whole files.
+
+Instead of reading every event through larcv, this reads the extents tables
+that larcv stores next to the voxels.  In Data/<product>_<producer>_group,
+`extents` holds, for each entry, the (first, N) range of its projections in
+`voxel_extents`, which holds the (first, N) range of each projection's voxels.
+The voxel counts are the N column of voxel_extents, gathered in chunks of
+entries, and the voxels themselves are never read.
+
+The percentiles are what MaxVoxels (max_voxels in io_templates) and
+--voxel-budget should be sized from, e.g.:
+
+    voxel_occupancy.py -f 'merged/*.h5' --producer sbndvoxels --product sparse3d -mb 64
+'''
+
+
+def count_voxels(input_file, product, producer, chunk_size):
+    '''Voxel count of every plane of every entry of a file, as [entries, planes]'''
+
+    with h5py.File(input_file, 'r') as _f:
+        group = _f['Data'][f'{product}_{producer}_group']
+        extents       = group['extents']
+        voxel_extents = group['voxel_extents']
+
+        n_entries = extents.shape[0]
+        counts = []
+        for start in range(0, n_entries, chunk_size):
+            stop = min(start + chunk_size, n_entries)
+
+            # The fields are (first, N):
+            entry_extents = extents[start:stop]
+            first  = entry_extents[entry_extents.dtype.names[0]].astype(numpy.int64)
+            planes = entry_extents[entry_extents.dtype.names[1]].astype(numpy.int64)
+            if (planes != planes[0]).any():
+                raise Exception(f"{input_file} has entries with different numbers of planes")
+
+            # One contiguous read for the projections of the whole chunk:
+            projections = voxel_extents[first[0]:first[-1] + planes[-1]]
+            n_voxels    = projections[projections.dtype.names[1]].astype(numpy.int64)
+            index = (first - first[0])[:,None] + numpy.arange(planes[0])
+            counts.append(n_voxels[index])
+
+    if len(counts) == 0:
+        return None
+    return numpy.concatenate(counts)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description     = 'Voxel occupancy of sparse tensors, read straight from the larcv extents',
+        formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-f','--file',
+        type     = str,
+        nargs    = '+',
+        required = True,
+        help     = "Input larcv file(s), globs or directories")
+    parser.add_argument('--product',
+        type    = str,
+        default = "sparse3d",
+        choices = ["sparse2d", "sparse3d"],
+        help    = "Sparse tensor product")
+    parser.add_argument('--producer',
+        type    = str,
+        default = "sbndvoxels",
+        help    = "Sparse tensor producer")
+    parser.add_argument('--chunk-size',
+        type    = int,
+        default = 100000,
+        help    = "Entries read at once")
+    parser.add_argument('-n','--n-workers',
+        type    = int,
+        default = os.cpu_count(),
+        help    = "Number of files to read at once")
+    parser.add_argument('--bins',
+        type    = int,
+        default = 20,
+        help    = "Number of bins of the voxel count histograms")
+    parser.add_argument('-mb','--minibatch-size',
+        type    = int,
+        default = 0,
+        help    = "If set, also print the voxels per minibatch of this many events")
+    parser.add_argument('-o','--output',
+        type    = str,
+        default = None,
+        help    = "Save the per entry counts and histograms to this .npz file")
+
+    args = parser.parse_args()
+
+    input_files = resolve_input_files(args.file)
+
+    start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(args.n_workers, len(input_files))) as pool:
+        counts = list(pool.map(count_voxels, input_files,
+            [args.product]*len(input_files), [args.producer]*len(input_files), [args.chunk_size]*len(input_files)))
+    counts = [ c for c in counts if c is not None ]
+
+    if len(counts) == 0:
+        # Nothing to histogram, and no way to know the number of planes:
+        print(f"Read 0 entries from {len(input_files)} files in {time.time() - start:.1f}s, the histograms are empty")
+        if args.output is not None:
+            numpy.savez(args.output, counts=numpy.zeros((0, 0), dtype=numpy.int64))
+        return
+
+    counts = numpy.concatenate(counts)
+
+    print(f"Read {counts.shape[0]} entries from {len(input_files)} files in {time.time() - start:.1f}s")
+
+    percentiles = [50, 90, 99, 99.9]
+    results = {'counts' : counts}
+    for plane in range(counts.shape[1]):
+        c = counts[:,plane]
+        values = numpy.percentile(c, percentiles)
+        print("  {p}: {av:.2f} +/- {rms:.2f}, {pct}, ({max} max)".format(
+            p   = plane,
+            av  = c.mean(),
+            rms = c.std(),
+            pct = ", ".join(f"p{q} {v:.0f}" for q, v in zip(percentiles, values)),
+            max = c.max()))
+
+        hist, edges = numpy.histogram(c, bins=args.bins)
+        width = max(1, int(numpy.log10(max(1, edges[-1]))) + 1)
+        for n, low, high in zip(hist, edges[:-1], edges[1:]):
+            print(f"    [{low:{width}.0f}, {high:{width}.0f}): {n}")
+        results[f'histogram_{plane}'] = hist
+        results[f'edges_{plane}']     = edges
+
+    if args.minibatch_size > 0:
+        total = counts.sum(axis=-1)
+        n_batches = len(total) // args.minibatch_size
+        batch_voxels = total[:n_batches * args.minibatch_size].reshape(n_batches, -1).sum(axis=-1)
+        print("Voxels per minibatch of {mb}: {av:.0f} mean, p99 {p99:.0f}, {max} max".format(
+            mb  = args.minibatch_size,
+            av  = batch_voxels.mean(),
+            p99 = numpy.percentile(batch_voxels, 99),
+            max = batch_voxels.max()))
+
+    if args.output is not None:
+        numpy.savez(args.output, **results)
+
+
+if __name__ == '__main__':
+    main()
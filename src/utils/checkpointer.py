@@ -0,0 +1,152 @@
+import os
+import glob
+import queue
+import threading
+
+import torch
+
+
+class checkpointer(object):
+    '''
+    Writes checkpoints from a background thread.
+
+    save() takes a snapshot of the state on the host and returns; the slow
+    part (torch.save to a possibly shared filesystem, updating the index,
+    removing old checkpoints) happens on the writer thread.  Each file is
+    written under a temporary name and renamed into place, so a checkpoint
+    in the index is always complete.
+
+    The index of retained checkpoints is kept in memory, and written out in
+    the same format as before:
+
+        latest: model-<step>.ckpt
+        <step>: model-<step>.ckpt
+        ...
+    '''
+
+    def __init__(self, directory, index_name="checkpoint", n_keep=100):
+
+        self.directory  = directory
+        self.index_path = os.path.join(directory, index_name)
+        self.n_keep     = n_keep
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Pick up checkpoints from earlier runs, so they count towards retention:
+        self._index = self._read_index()
+
+        # Only one snapshot waits for the writer at a time, which bounds the
+        # host memory used to twice the state size:
+        self._queue  = queue.Queue(maxsize=1)
+        self._error  = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _read_index(self):
+        index = {}
+        if not os.path.isfile(self.index_path):
+            return index
+        with open(self.index_path, 'r') as _chkpt:
+            for line in _chkpt.readlines():
+                vals = line.rstrip('\n').split(":")
+                if vals[0] != 'latest' and len(vals) == 2:
+                    index[int(vals[0])] = vals[1].replace(' ', '')
+        return index
+
+    def _snapshot(self, value, events):
+        '''Copy the tensors in a (nested) state dict to the host'''
+
+        if torch.is_tensor(value):
+            if value.is_cuda:
+                # Start the copy now, and let the writer wait for it:
+                host = torch.empty(value.shape, dtype=value.dtype, pin_memory=True)
+                host.copy_(value.detach(), non_blocking=True)
+                if len(events) == 0:
+                    events.append(torch.cuda.Event())
+                return host
+            return value.detach().clone()
+        if isinstance(value, dict):
+            return type(value)((k, self._snapshot(v, events)) for k, v in value.items())
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._snapshot(v, events) for v in value)
+        return value
+
+    def save(self, global_step, state, file_name=None, update_index=True):
+        '''Snapshot the state and queue it to be written as model-<global_step>.ckpt
+
+        Extra files belonging to a checkpoint (like per rank shards) are
+        written with file_name set and update_index False.  They have to
+        be named model-<global_step>.* to be removed along with it.
+        '''
+
+        if file_name is None:
+            file_name = 'model-{}.ckpt'.format(global_step)
+
+        self._raise_error()
+
+        events = []
+        snapshot = self._snapshot(state, events)
+        if len(events) > 0:
+            # One event after all of the device to host copies:
+            events[0].record()
+
+        self._queue.put((global_step, snapshot, events, file_name, update_index))
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, global_step, snapshot, events, file_name, update_index):
+
+        for event in events:
+            event.synchronize()
+
+        file_path = os.path.join(self.directory, file_name)
+
+        torch.save(snapshot, file_path + ".tmp")
+        os.replace(file_path + ".tmp", file_path)
+
+        if not update_index:
+            return
+
+        self._index[global_step] = file_name
+
+        # Remove the oldest checkpoints, and their shards, while the number is greater than n_keep
+        while len(self._index) > self.n_keep:
+            min_index = min(self._index.keys())
+            self._index.pop(min_index)
+            for file_to_remove in glob.glob(os.path.join(self.directory, 'model-{}.*'.format(min_index))):
+                os.remove(file_to_remove)
+
+        # Update the checkpoint index, also atomically:
+        with open(self.index_path + ".tmp", 'w') as _chkpt:
+            _chkpt.write('latest: {}\n'.format(file_name))
+            for key in sorted(self._index.keys(), reverse=True):
+                _chkpt.write('{}: {}\n'.format(key, self._index[key]))
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise Exception(f"Writing a checkpoint failed: {error}")
+
+    def wait(self):
+        '''Block until every queued checkpoint is on disk'''
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise_error()
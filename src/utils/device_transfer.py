@@ -0,0 +1,139 @@
+import numpy
+
+import torch
+
+
+class device_transfer(object):
+    '''
+    Moves converted minibatches from the host to the compute device.
+
+    Numpy arrays are wrapped with torch.from_numpy, so on CPU there is no copy at
+    all.  On GPU, the arrays are optionally staged through a reusable pool of
+    pinned buffers and copied with non_blocking=True on a side stream.  A batch
+    handed to preload() is copied while the current step is still computing,
+    and ready() makes the compute stream wait for it.
+    '''
+
+    # Two sets of pinned buffers: one being copied from, one being filled.
+    _n_slots = 2
+
+    def __init__(self, device, image_mode, pin_memory=False):
+
+        self.device     = device
+        self.image_mode = image_mode
+
+        self._use_cuda   = device.type == 'cuda'
+        self._pin_memory = pin_memory and self._use_cuda
+
+        if self._use_cuda:
+            self._stream = torch.cuda.Stream(device=device)
+        else:
+            self._stream = None
+
+        # Pinned buffers and the event marking when each was last copied out:
+        self._pinned = {}
+        self._slot   = 0
+
+    def __call__(self, minibatch_data):
+        return self.ready(self.preload(minibatch_data))
+
+    def preload(self, minibatch_data):
+        '''Start moving a minibatch to the device, without waiting for it'''
+
+        if self._use_cuda:
+            with torch.cuda.stream(self._stream):
+                minibatch_data = self._convert(minibatch_data)
+            self._slot = (self._slot + 1) % self._n_slots
+            return minibatch_data
+        else:
+            return self._convert(minibatch_data)
+
+    def ready(self, minibatch_data):
+        '''Return a preloaded minibatch, ready to use on the compute stream'''
+
+        if self._use_cuda:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self._stream)
+            # Tell the caching allocator these tensors are now used on the compute stream:
+            for key in minibatch_data:
+                for tensor in self._device_tensors(minibatch_data[key]):
+                    tensor.record_stream(current_stream)
+
+        return minibatch_data
+
+    def _device_tensors(self, value):
+        if torch.is_tensor(value):
+            return [value] if value.is_cuda else []
+        if isinstance(value, (tuple, list)):
+            return [v for v in value if torch.is_tensor(v) and v.is_cuda]
+        if hasattr(value, 'stores'):
+            # torch_geometric Batch
+            return [v for store in value.stores for v in store.values()
+                if torch.is_tensor(v) and v.is_cuda]
+        return []
+
+    def _from_numpy(self, array):
+        if torch.is_tensor(array):
+            return array
+        array = numpy.ascontiguousarray(array)
+        if not array.flags.writeable:
+            # Read only arrays (like memory mapped caches) can't be shared with torch:
+            array = array.copy()
+        return torch.from_numpy(array)
+
+    def _pinned_buffer(self, key, tensor):
+
+        # Reuse the pinned buffer for this key and slot if it is big enough:
+        slot_key = (key, self._slot)
+        if slot_key in self._pinned:
+            buffer, event = self._pinned[slot_key]
+            if buffer.dtype == tensor.dtype and buffer.numel() >= tensor.numel():
+                # Don't overwrite it while its last copy could still be in flight:
+                event.synchronize()
+                buffer = buffer[:tensor.numel()].view(tensor.shape)
+                buffer.copy_(tensor)
+                return buffer
+
+        buffer = torch.empty(
+            (max(tensor.numel(), 1),), dtype=tensor.dtype, pin_memory=True)
+        self._pinned[slot_key] = (buffer, torch.cuda.Event())
+        buffer = buffer[:tensor.numel()].view(tensor.shape)
+        buffer.copy_(tensor)
+        return buffer
+
+    def _to_device(self, key, array):
+
+        tensor = self._from_numpy(array)
+
+        if not self._use_cuda:
+            return tensor
+
+        if self._pin_memory:
+            tensor = self._pinned_buffer(key, tensor)
+            tensor = tensor.to(self.device, non_blocking=True)
+            self._pinned[(key, self._slot)][1].record(self._stream)
+            return tensor
+
+        return tensor.to(self.device, non_blocking=True)
+
+    def _convert(self, minibatch_data):
+
+        for key in minibatch_data:
+            if key == 'entries' or key =='event_ids':
+                continue
+            if key == 'image' and self.image_mode == "sparse":
+                # Sparse convolutions take the coordinates on the host and the features on the device
+                minibatch_data['image'] = (
+                        self._from_numpy(minibatch_data['image'][0]).long(),
+                        self._to_device('features', minibatch_data['image'][1]),
+                        minibatch_data['image'][2],
+                    )
+            elif key == 'image' and self.image_mode == 'graph':
+                image = minibatch_data[key]
+                if self._pin_memory:
+                    image = image.pin_memory()
+                minibatch_data[key] = image.to(self.device, non_blocking=self._use_cuda)
+            else:
+                minibatch_data[key] = self._to_device(key, minibatch_data[key])
+
+        return minibatch_data
@@ -9,20 +9,18 @@ import socket
 import numpy
 import torch
 
-from mpi4py import MPI
-
 # Pytorch data parallel:
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
-import torch.multiprocessing as mp
-
-import horovod.torch as hvd
 
-from larcv.distributed_queue_interface import queue_interface
+# Horovod is only needed for the horovod backend:
+try:
+    import horovod.torch as hvd
+except ImportError:
+    hvd = None
 
 from .torch_trainer import torch_trainer
-
-import tensorboardX
+from .summary_writer import metric_aggregator
 
 
 
@@ -35,31 +33,76 @@ class distributed_trainer(torch_trainer):
     '''
     def __init__(self, args):
 
+        # With DDP, the process group has to exist before the IO is set up,
+        # so distributed IO can use it:
+        if args.distributed_backend == "DDP":
+            self.rank, self.world_size = self.init_process_group(args)
+        else:
+            if hvd is None:
+                raise Exception("The horovod backend needs horovod installed, use --distributed-backend DDP without it")
+            # Horovod is initialized in exec.py.  We use MPI to pick the rank and world size:
+            from mpi4py import MPI
+            self.rank       = MPI.COMM_WORLD.Get_rank()
+            self.world_size = MPI.COMM_WORLD.Get_size()
+
         torch_trainer.__init__(self, args)
         # Rely on the base class for most standard parameters, only
         # search for parameters relevant for distributed computing here
 
-        # Put the IO rank as the last rank in the COMM, since rank 0 does tf saves
-        #
-        # if self.args.compute_mode == "GPU":
-        #     print(os.environ['CUDA_VISIBLE_DEVICES'])
+    def init_process_group(self, args):
+        '''Set up torch.distributed, and return the rank and world size
+
+        With --ddp-rendezvous env, the rank, world size and master address
+        come from the environment, as set by torchrun.  Otherwise it is the
+        path of a file on a filesystem all ranks share, and the rank and
+        world size come from the environment if set, or from MPI.
+        '''
+
+        if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+            rank       = int(os.environ['RANK'])
+            world_size = int(os.environ['WORLD_SIZE'])
+        else:
+            from mpi4py import MPI
+            rank       = MPI.COMM_WORLD.Get_rank()
+            world_size = MPI.COMM_WORLD.Get_size()
+
+        if args.ddp_rendezvous == "env":
+            init_method = "env://"
+        else:
+            init_method = "file://" + os.path.abspath(args.ddp_rendezvous)
 
-        # We use MPI to pick the rank and world size:
+        if args.compute_mode == "GPU" and dist.is_nccl_available():
+            backend = "nccl"
+        else:
+            backend = "gloo"
 
-        # Rank0
+        dist.init_process_group(backend, init_method=init_method, rank=rank, world_size=world_size)
 
-        self.rank = MPI.COMM_WORLD.Get_rank()
-        world_size = MPI.COMM_WORLD.Get_size()
+        # nccl only reduces device tensors, and gloo is given host tensors:
+        if backend == "nccl":
+            self._collective_device = torch.device('cuda', torch.cuda.current_device())
+        else:
+            self._collective_device = torch.device('cpu')
 
+        return rank, world_size
 
-        if self.args.distributed_backend == "DDP":
-            init_method = f'file:///home/cadams/.torch_ddp_init'
-            dist.init_process_group("nccl", init_method=init_method,rank=self.rank, world_size=world_size)
+    def stop(self):
+        torch_trainer.stop(self)
+        if self.args.distributed_backend == "DDP" and dist.is_initialized():
+            dist.destroy_process_group()
 
-        # if self.rank == 0:
-        #     hostname = socket.gethostname()
-        #     IPAddr = socket.gethostbyname(hostname)
+    def allgather(self, value):
+        '''Gather a small picklable value from every rank'''
+        if self.args.distributed_backend == "horovod":
+            return hvd.allgather_object(value)
+        values = [ None ] * self.world_size
+        dist.all_gather_object(values, value)
+        return values
 
+    def label_counts(self):
+        # Count (and write the sidecars) once, and share the counts:
+        counts = torch_trainer.label_counts(self) if self.rank == 0 else None
+        return self.allgather(counts)[0]
 
     def print(self, *argv):
         if self.rank == 0:
@@ -68,8 +111,36 @@ class distributed_trainer(torch_trainer):
 
     def save_model(self):
 
+        if not self.args.shard_optimizer_state:
+            if self.rank == 0:
+                torch_trainer.save_model(self)
+            return
+
+        # Every rank writes the optimizer state of every world_size'th
+        # parameter, and rank 0 writes the rest of the checkpoint:
+        world_size = self.world_size
+        shard_name = lambda rank : 'model-{}.optim{}of{}.ckpt'.format(self._global_step, rank, world_size)
+
+        state = self.checkpoint_state()
+        optimizer_state = state['optimizer']
+
+        shard = {
+            'state' : { index : value for index, value in optimizer_state['state'].items()
+                if index % world_size == self.rank }
+        }
+        # The shards and the main file are written independently, so the index
+        # can list a checkpoint before all of its shards are on disk.  restore_model
+        # skips a checkpoint like that for the one before it.
+        self.get_checkpointer().save(self._global_step, shard,
+            file_name = shard_name(self.rank), update_index = False)
+
         if self.rank == 0:
-            torch_trainer.save_model(self)
+            state['optimizer'] = {
+                'state'        : {},
+                'param_groups' : optimizer_state['param_groups'],
+            }
+            state['optimizer_shards'] = [ shard_name(rank) for rank in range(world_size) ]
+            self.get_checkpointer().save(self._global_step, state)
 
 
     def init_optimizer(self):
@@ -80,13 +151,37 @@ class distributed_trainer(torch_trainer):
         torch_trainer.init_optimizer(self)
 
         if self.args.distributed_backend == "horovod":
-            self._opt = hvd.DistributedOptimizer(self._opt, named_parameters=self._net.named_parameters())
+            # With gradient accumulation, horovod only allreduces on the last backward pass of each step:
+            self._opt = hvd.DistributedOptimizer(self._opt,
+                named_parameters         = self._net.named_parameters(),
+                backward_passes_per_step = self.args.accumulation_steps)
+
+    def _step_optimizer(self):
+
+        if self.args.distributed_backend == "horovod" and self._grad_scaler.is_enabled():
+            # The scaler checks the gradients for inf/nan when unscaling, so the
+            # horovod allreduce has to finish first.  Then step without
+            # synchronizing again:
+            self._opt.synchronize()
+            with self._opt.skip_synchronize():
+                torch_trainer._step_optimizer(self)
+        else:
+            torch_trainer._step_optimizer(self)
+
+    def accumulation_context(self, final):
+
+        # DDP reduces gradients during every backward pass, unless told not to:
+        if self.args.distributed_backend == "DDP" and not final:
+            return self._net.no_sync()
+        return torch_trainer.accumulation_context(self, final)
 
     def init_network(self):
 
         torch_trainer.init_network(self)
         if self.args.distributed_backend == "DDP":
-            self._net = DDP(self._net)
+            self._net = DDP(self._net,
+                bucket_cap_mb           = self.args.ddp_bucket_mb,
+                gradient_as_bucket_view = True)
 
     def init_saver(self):
         if self.rank == 0:
@@ -98,34 +193,121 @@ class distributed_trainer(torch_trainer):
 
     def restore_model(self):
 
-        if self.rank == 0:
-            # On the root rank, load the model:
-            state = torch_trainer.restore_model(self)
-        else:
+        # Every rank reads the checkpoint index and memory maps the checkpoint
+        # itself, which only works if they all see the files:
+        chkp_file, state, n_skipped = self.complete_checkpoint()
+
+        found = self.allgather((None if chkp_file is None else os.path.basename(chkp_file), n_skipped))
+        names = [ name for name, _ in found ]
+        if all(name is None for name in names):
+            if any(skipped > 0 for _, skipped in found):
+                raise Exception("No checkpoint has all of its optimizer shards, can't resume training")
+            return None
+        if any(name != names[0] for name in names):
+            # Not on a shared filesystem, so send the state from the root rank:
+            if names[0] is None:
+                raise Exception(f"The root rank has no complete checkpoint to send, other ranks found {set(names)}")
+            return self.broadcast_restore(state)
+
+        # A cheap consistency check, instead of sending the state around:
+        signature = (
+            os.path.basename(chkp_file),
+            int(state['global_step']),
+            len(state['state_dict']),
+            len(state['optimizer']['state']) if 'optimizer' in state else 0,
+        )
+        signatures = self.allgather(signature)
+        if any(s != signatures[0] for s in signatures):
+            raise Exception(f"Ranks restored inconsistent checkpoints: {set(signatures)}")
+
+        return state
+
+    def complete_checkpoint(self):
+        '''The newest checkpoint in the index that this rank can read all of
+
+        Returns the file, its state with the optimizer shards merged in, and
+        the number of newer checkpoints skipped for missing shards.
+        '''
+
+        n_skipped = 0
+        for chkp_file in self.checkpoint_files():
+            if not os.path.isfile(chkp_file):
+                continue
+            state = self.load_checkpoint(chkp_file, mmap=True)
+            if 'optimizer_shards' not in state or not self.args.training:
+                return chkp_file, state, n_skipped
+
+            # Each rank holds a full copy of the optimizer, so gather all the shards:
+            directory   = os.path.dirname(chkp_file)
+            shard_files = [ os.path.join(directory, shard_name) for shard_name in state['optimizer_shards'] ]
+            missing     = [ f for f in shard_files if not os.path.isfile(f) ]
+            if len(missing) > 0:
+                # Written before every rank finished its shard:
+                self.print(f"Skipping checkpoint {chkp_file}, it is missing optimizer shards {missing}")
+                n_skipped += 1
+                continue
+            for shard_file in shard_files:
+                shard = self.load_checkpoint(shard_file, mmap=True)
+                state['optimizer']['state'].update(shard['state'])
+            self.print("Restoring weights from ", chkp_file)
+            return chkp_file, state, n_skipped
+
+        return None, None, n_skipped
+
+    def broadcast_restore(self, state):
+
+        # The root rank's checkpoint, with its shards already merged, goes to everyone:
+        if self.rank != 0:
             state = {}
 
         # Here, we need to broad cast the entire state:
-        state = hvd.broadcast_object(state, root_rank = 0)
+        if self.args.distributed_backend == "horovod":
+            state = hvd.broadcast_object(state, root_rank = 0)
+        else:
+            state = [ state ]
+            dist.broadcast_object_list(state, src = 0)
+            state = state[0]
 
         return state
 
-    def summary(self, metrics, saver=""):
-        if self.rank == 0:
-            torch_trainer.summary(self, metrics, saver)
-        return
+    def allreduce_metrics(self):
+
+        if self.args.distributed_backend == "horovod":
+            return lambda packed : hvd.allreduce(packed, name = "metrics")
+        else:
+            world_size = self.world_size
+            device     = self._collective_device
+            def allreduce(packed):
+                # Metrics that were all python floats are packed on the host:
+                packed = packed.to(device)
+                dist.all_reduce(packed)
+                return packed / world_size
+            return allreduce
+
+    def n_ranks(self):
+        return self.world_size
+
+    def rank_index(self):
+        return self.rank
+
+    def allreduce_sum(self, tensor):
+        if self.args.distributed_backend == "horovod":
+            return hvd.allreduce(tensor, name = "eval", op = hvd.Sum)
+        reduced = tensor.to(self._collective_device)
+        dist.all_reduce(reduced)
+        return reduced.to(tensor.device)
 
     def _compute_metrics(self, logits, minibatch_data, loss):
         # This function calls the parent function which computes local metrics.
-        # Then, it performs an all reduce on all metrics:
         metrics = torch_trainer._compute_metrics(self, logits, minibatch_data, loss)
 
-
-        for key in metrics:
-            # self.print("All reducing ", key)
-            if self.args.distributed_backend == "horovod":
-                metrics[key] = hvd.allreduce(metrics[key], name = key)
-            else:
-                pass
+        # Only the log line needs the metrics of this step reduced over ranks;
+        # summaries reduce their own accumulated metrics.  So on logging steps,
+        # pack them all into one flat tensor and reduce it in one collective:
+        if self._global_step % self.args.logging_iteration == 0:
+            aggregator = metric_aggregator()
+            aggregator.add(metrics)
+            metrics = aggregator.reduce(self.allreduce_metrics())
 
         return metrics
 
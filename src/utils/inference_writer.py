@@ -0,0 +1,101 @@
+import numpy
+import h5py
+
+
+class inference_writer(object):
+    '''
+    Writes inference results as columnar arrays in an hdf5 file.
+
+    Each label key gets one [N_events, N_classes] dataset of softmax scores
+    under scores/, next to the entries and event_ids datasets that identify
+    the events.  Rows are buffered in memory and appended in bulk every
+    flush_size events, instead of one larcv write per event per key.
+    '''
+
+    def __init__(self, output_file, flush_size=10000, attributes=None):
+
+        self._file = h5py.File(str(output_file), 'w')
+        self._flush_size = flush_size
+
+        if attributes is not None:
+            for key in attributes:
+                self._file.attrs[key] = attributes[key]
+
+        self._buffers  = {}
+        self._buffered = 0
+
+        # Events passed to write(), and events actually on disk:
+        self.n_events  = 0
+        self.n_written = 0
+
+    def write(self, entries, event_ids, scores):
+        '''Buffer the results of one minibatch
+
+        scores is a dict of {label key : [B, N_classes] array}.
+        '''
+
+        self._append('entries',   numpy.asarray(entries))
+        self._append('event_ids', numpy.asarray(event_ids))
+        for key in scores:
+            self._append('scores/' + key, numpy.asarray(scores[key]))
+
+        self._buffered += len(entries)
+        self.n_events  += len(entries)
+        if self._buffered >= self._flush_size:
+            self.flush()
+
+    def _append(self, name, array):
+        self._buffers.setdefault(name, []).append(array)
+
+    def flush(self):
+
+        if self._buffered == 0:
+            return
+
+        for name in self._buffers:
+            data = numpy.concatenate(self._buffers[name])
+            if name not in self._file:
+                self._file.create_dataset(name,
+                    data     = data,
+                    maxshape = (None,) + data.shape[1:],
+                    chunks   = True)
+            else:
+                dataset = self._file[name]
+                start = dataset.shape[0]
+                dataset.resize(start + len(data), axis=0)
+                dataset[start:] = data
+
+        self.n_written += self._buffered
+        self._buffers  = {}
+        self._buffered = 0
+
+    def close(self):
+        if self._file is not None:
+            self.flush()
+            self._file.close()
+            self._file = None
+
+
+def merge(output_file, shard_files):
+    '''Concatenate inference outputs, in the order given, into one file'''
+
+    with h5py.File(str(output_file), 'w') as _out:
+
+        shards = [ h5py.File(str(f), 'r') for f in shard_files ]
+
+        try:
+            for key in shards[0].attrs:
+                _out.attrs[key] = shards[0].attrs[key]
+
+            names = []
+            shards[0].visit(lambda name : names.append(name) if isinstance(shards[0][name], h5py.Dataset) else None)
+
+            for name in names:
+                data = numpy.concatenate([ shard[name][:] for shard in shards if name in shard ])
+                _out.create_dataset(name,
+                    data     = data,
+                    maxshape = (None,) + data.shape[1:],
+                    chunks   = True)
+        finally:
+            for shard in shards:
+                shard.close()
@@ -6,11 +6,13 @@ import numpy
 import torch
 
 from . larcvio   import larcv_fetcher
+from . import device_transfer
+from . import inference_writer
+from . import checkpointer
 
-import datetime
+import time
 
-# This uses tensorboardX to save summaries and metrics to tensorboard compatible files.
-import tensorboardX
+from .summary_writer import summary_writer, metric_aggregator
 
 
 class iocore(object):
@@ -24,14 +26,37 @@ class iocore(object):
     '''
     def __init__(self, args):
         self.args = args
+
+        if self.args.intra_op_threads > 0:
+            torch.set_num_threads(self.args.intra_op_threads)
+
         self.larcv_fetcher = larcv_fetcher.larcv_fetcher(
             mode            = args.mode,
             distributed     = args.distributed,
             image_mode      = args.image_mode,
             label_mode      = self.args.label_mode,
             input_dimension = self.args.input_dimension,
+            prefetch_depth  = self.args.prefetch_depth,
+            backend         = self.args.io_backend,
         )
 
+        # Only used in inference mode:
+        self._inference_writer = None
+
+        # Background checkpoint writer, created on the first save:
+        self._checkpointer = None
+
+        self._previous_log_time = None
+
+        # Metrics accumulated between summaries, per saver:
+        self._aggregators = {}
+
+        # Host to device copies:
+        self._transfer = device_transfer.device_transfer(
+            device     = self.get_device(),
+            image_mode = self.args.image_mode,
+            pin_memory = self.args.pin_memory)
+
 
 
 
@@ -51,7 +76,9 @@ class iocore(object):
             name            = "primary",
             input_file      = self.args.file,
             batch_size      = self.args.minibatch_size,
-            color           = color
+            color           = color,
+            start_index     = self.args.start_index,
+            voxel_budget    = self.args.voxel_budget if self.args.mode == "train" else 0,
         )
 
         # Check that the training file exists:
@@ -72,17 +99,25 @@ class iocore(object):
 
         if self.args.aux_file is not None:
             if self.args.mode == "train":
-                # Fetching data for on the fly testing:
+                # Fetching data for on the fly testing.  A full evaluation
+                # sweeps the file in order instead of sampling minibatches:
+                evaluate = self.args.eval_iteration > 0
                 self._aux_data_size = self.larcv_fetcher.prepare_sample(
-                    name            = "aux",
+                    name            = "eval" if evaluate else "aux",
                     input_file      = self.args.aux_file,
-                    batch_size      = self.args.minibatch_size,
-                    color           = color
+                    batch_size      = self.args.aux_minibatch_size,
+                    color           = color,
+                    serial          = evaluate
                 )
             elif self.args.mode == "inference":
-                raise Exception("Need to check the inference writer works")
-                self._aux_data_size = self.larcv_fetcher.prepare_writer(
-                    input_file = self.args.file, output_file = str(self.args.aux_file))
+                # In inference mode, the aux file is where the scores are written:
+                self._inference_writer = inference_writer.inference_writer(
+                    output_file = self.args.aux_file,
+                    attributes  = {
+                        'input_file' : ",".join(str(f) for f in self.args.file),
+                        'label_mode' : self.args.label_mode,
+                        'network'    : self.args.network,
+                    })
 
 
         # if 'output_file' in self.args and self.args.output_file is not None:
@@ -121,12 +156,12 @@ class iocore(object):
 
         # This sets up the summary saver:
         if self.args.training:
-            self._saver = tensorboardX.SummaryWriter(self.args.log_directory)
+            self._saver = summary_writer(self.args.log_directory)
 
         if self.args.aux_file is not None and self.args.training:
-            self._aux_saver = tensorboardX.SummaryWriter(self.args.log_directory + "/test/")
+            self._aux_saver = summary_writer(self.args.log_directory + "/test/")
         elif self.args.aux_file is not None and not self.args.training:
-            self._aux_saver = tensorboardX.SummaryWriter(self.args.log_directory + "/val/")
+            self._aux_saver = summary_writer(self.args.log_directory + "/val/")
 
         else:
             self._aux_saver = None
@@ -140,8 +175,8 @@ class iocore(object):
         # Here, either restore the weights of the network or initialize it:
 
 
-    def restore_model(self):
-        ''' This function attempts to restore the model from file
+    def latest_checkpoint(self):
+        ''' Find the latest checkpoint file in the checkpoint index, or None
         '''
 
         _, checkpoint_file_path = self.get_model_filepath()
@@ -153,6 +188,7 @@ class iocore(object):
             return None
         # Parse the checkpoint file and use that to get the latest file path
 
+        chkp_file = None
         with open(checkpoint_file_path, 'r') as _ckp:
             for line in _ckp.readlines():
                 if line.startswith("latest: "):
@@ -161,20 +197,70 @@ class iocore(object):
                     self.print("Restoring weights from ", chkp_file)
                     break
 
+        return chkp_file
+
+    def checkpoint_files(self):
+        ''' All of the checkpoint files in the checkpoint index, latest first
+        '''
+
+        _, checkpoint_file_path = self.get_model_filepath()
+
+        if not os.path.isfile(checkpoint_file_path):
+            return []
+
+        latest = []
+        steps  = {}
+        with open(checkpoint_file_path, 'r') as _ckp:
+            for line in _ckp.readlines():
+                vals = line.rstrip('\n').split(":")
+                if len(vals) != 2:
+                    continue
+                chkp_file = os.path.dirname(checkpoint_file_path) + "/" + vals[1].replace(' ', '')
+                if vals[0] == 'latest':
+                    latest = [ chkp_file ]
+                else:
+                    steps[int(vals[0])] = chkp_file
+
+        older = [ steps[step] for step in sorted(steps.keys(), reverse=True) ]
+        return latest + [ f for f in older if f not in latest ]
+
+    def load_checkpoint(self, chkp_file, mmap=False):
+        ''' Load a checkpoint file.  With mmap, the tensors are mapped from
+        the file instead of read into memory up front.
+
+        The checkpoints are our own, and hold more than tensors (like the
+        scheduler state), so they are unpickled in full.
+        '''
+
         if self.args.compute_mode == "CPU":
-            state = torch.load(chkp_file, map_location='cpu')
+            return torch.load(chkp_file, map_location='cpu', mmap=mmap, weights_only=False)
         else:
-            state = torch.load(chkp_file)
+            return torch.load(chkp_file, mmap=mmap, weights_only=False)
+
+    def restore_model(self):
+        ''' This function attempts to restore the model from file
+        '''
+
+        chkp_file = self.latest_checkpoint()
+        if chkp_file is None:
+            return None
 
-        return state
+        return self.load_checkpoint(chkp_file)
 
     def load_state(self, state):
 
 
-        self._net.load_state_dict(state['state_dict'])
+        self.network_module().load_state_dict(state['state_dict'])
+        self._global_step = state['global_step']
+
+        # Inference only needs the weights:
+        if not self.args.training:
+            return True
+
         self._opt.load_state_dict(state['optimizer'])
         self.lr_scheduler.load_state_dict(state['scheduler'])
-        self._global_step = state['global_step']
+        if 'scaler' in state and self._grad_scaler is not None:
+            self._grad_scaler.load_state_dict(state['scaler'])
 
         # If using GPUs, move the model to GPU:
         if self.args.compute_mode == "GPU":
@@ -186,60 +272,45 @@ class iocore(object):
         return True
 
 
-    def save_model(self):
-        '''Save the model to file
-
-        '''
+    def network_module(self):
+        # Checkpoints hold the bare network, not a DistributedDataParallel wrapper:
+        return getattr(self._net, 'module', self._net)
 
-        current_file_path, checkpoint_file_path = self.get_model_filepath()
+    def checkpoint_state(self):
+        '''The state saved in a checkpoint'''
 
-        # save the model state into the file path:
         state_dict = {
             'global_step' : self._global_step,
-            'state_dict'  : self._net.state_dict(),
+            'state_dict'  : self.network_module().state_dict(),
             'optimizer'   : self._opt.state_dict(),
             'scheduler'   : self.lr_scheduler.state_dict(),
         }
+        if self._grad_scaler is not None and self._grad_scaler.is_enabled():
+            state_dict['scaler'] = self._grad_scaler.state_dict()
 
-        # Make sure the path actually exists:
-        if not os.path.isdir(os.path.dirname(current_file_path)):
-            os.makedirs(os.path.dirname(current_file_path))
+        return state_dict
 
-        torch.save(state_dict, current_file_path)
+    def get_checkpointer(self):
 
-        # Parse the checkpoint file to see what the last checkpoints were:
+        if self._checkpointer is None:
+            _, checkpoint_file_path = self.get_model_filepath()
+            # Keep the last 100 checkpoints
+            self._checkpointer = checkpointer.checkpointer(
+                directory  = os.path.dirname(checkpoint_file_path),
+                index_name = os.path.basename(checkpoint_file_path),
+                n_keep     = 100)
 
-        # Keep only the last 5 checkpoints
-        n_keep = 100
-
-
-        past_checkpoint_files = {}
-        try:
-            with open(checkpoint_file_path, 'r') as _chkpt:
-                for line in _chkpt.readlines():
-                    line = line.rstrip('\n')
-                    vals = line.split(":")
-                    if vals[0] != 'latest':
-                        past_checkpoint_files.update({int(vals[0]) : vals[1].replace(' ', '')})
-        except:
-            pass
-
-
-        # Remove the oldest checkpoints while the number is greater than n_keep
-        while len(past_checkpoint_files) >= n_keep:
-            min_index = min(past_checkpoint_files.keys())
-            file_to_remove = os.path.dirname(checkpoint_file_path) + "/" + past_checkpoint_files[min_index]
-            os.remove(file_to_remove)
-            past_checkpoint_files.pop(min_index)
+        return self._checkpointer
 
+    def save_model(self):
+        '''Save the model to file
 
+        The state is snapshotted to the host here, and written out by a
+        background checkpointer so the training loop doesn't wait on the
+        filesystem.
+        '''
 
-        # Update the checkpoint file
-        with open(checkpoint_file_path, 'w') as _chkpt:
-            _chkpt.write('latest: {}\n'.format(os.path.basename(current_file_path)))
-            _chkpt.write('{}: {}\n'.format(self._global_step, os.path.basename(current_file_path)))
-            for key in past_checkpoint_files:
-                _chkpt.write('{}: {}\n'.format(key, past_checkpoint_files[key]))
+        self.get_checkpointer().save(self._global_step, self.checkpoint_state())
 
 
     def get_model_filepath(self):
@@ -268,7 +339,7 @@ class iocore(object):
 
         if self._global_step % self.args.logging_iteration == 0:
 
-            self._current_log_time = datetime.datetime.now()
+            self._current_log_time = time.perf_counter()
 
             s = ""
 
@@ -276,26 +347,22 @@ class iocore(object):
                 # This prints out the iteration for ana steps
                 s += "it.: {}, ".format(metrics['it.'])
 
-            # Build up a string for logging:
-            if self._log_keys != []:
-                s += ", ".join(["{0}: {1:.3}".format(key, metrics[key]) for key in self._log_keys])
-            else:
-                s += ", ".join(["{0}: {1:.3}".format(key, metrics[key]) for key in metrics])
+            # Build up a string for logging, with one copy of the values to the host:
+            keys = self._log_keys if self._log_keys != [] else [ key for key in metrics if key != 'it.' ]
+            values = metric_aggregator()
+            values.add({ key : metrics[key] for key in keys })
+            values = values.reduce()
+            s += ", ".join(["{0}: {1:.3}".format(key, values[key]) for key in keys])
 
 
-            try:
+            if self._previous_log_time is not None and 'io_fetch_time' in metrics:
                 s += " ({:.2}s / {:.2} IOs / {:.2})".format(
-                    (self._current_log_time - self._previous_log_time).total_seconds(),
+                    self._current_log_time - self._previous_log_time,
                     metrics['io_fetch_time'],
                     metrics['step_time'])
-            except:
-                pass
 
-            try:
-                s += " (LR: {:.4})".format(
-                    self._opt.state_dict()['param_groups'][0]['lr'])
-            except:
-                pass
+            if self.args.training:
+                s += " (LR: {:.4})".format(self.learning_rate())
 
             self._previous_log_time = self._current_log_time
 
@@ -303,67 +370,60 @@ class iocore(object):
 
 
 
+    def learning_rate(self):
+        # Read straight from the optimizer, rather than building its state dict:
+        return self._opt.param_groups[0]['lr']
+
+    def allreduce_metrics(self):
+        '''A function averaging a flat tensor of metrics over all ranks, or None'''
+        return None
+
     def summary(self, metrics,saver=""):
+        '''Accumulate metrics, and write their means every summary_iteration steps
+
+        Validation metrics are written every time, since validation steps
+        are already infrequent.  In distributed training, every rank
+        accumulates its own metrics and they are reduced together when
+        written, so every rank has to call this.
+        '''
+
+        if saver not in self._aggregators:
+            self._aggregators[saver] = metric_aggregator()
+        self._aggregators[saver].add(metrics)
 
-        if self._saver is None:
+        if saver != "test" and self._global_step % self.args.summary_iteration != 0:
             return
 
-        if self._global_step % self.args.summary_iteration == 0:
-            for metric in metrics:
-                name = metric
-                if saver == "test":
-                    self._aux_saver.add_scalar(metric, metrics[metric], self._global_step)
-                else:
-                    self._saver.add_scalar(metric, metrics[metric], self._global_step)
+        scalars = self._aggregators[saver].reduce(self.allreduce_metrics())
+        scalars["learning_rate"] = self.learning_rate()
 
+        if saver == "test":
+            writer = self._aux_saver
+        else:
+            writer = self._saver
 
-            # try to get the learning rate
-            if saver == "test":
-                self._aux_saver.add_scalar("learning_rate", self._opt.state_dict()['param_groups'][0]['lr'], self._global_step)
-            else:
-                self._saver.add_scalar("learning_rate", self._opt.state_dict()['param_groups'][0]['lr'], self._global_step)
-            pass
+        if writer is not None:
+            writer.add_scalars(scalars, self._global_step)
 
 
 
     def to_torch(self, minibatch_data, device=None):
 
-        # Convert the input data to torch tensors
-        if self.args.compute_mode == "GPU":
-            if device is None:
-                device = torch.device('cuda')
-            # print(device)
-
-        else:
-            if device is None:
-                device = torch.device('cpu')
-
-
-        for key in minibatch_data:
-            if key == 'entries' or key =='event_ids':
-                continue
-            if key == 'image' and self.args.image_mode == "sparse":
-                if self.args.input_dimension == 3:
-                    minibatch_data['image'] = (
-                            torch.tensor(minibatch_data['image'][0]).long(),
-                            torch.tensor(minibatch_data['image'][1], device=device),
-                            minibatch_data['image'][2],
-                        )
-                else:
-                    minibatch_data['image'] = (
-                            torch.tensor(minibatch_data['image'][0]).long(),
-                            torch.tensor(minibatch_data['image'][1], device=device),
-                            minibatch_data['image'][2],
-                        )
-            elif key == 'image' and self.args.image_mode == 'graph':
-                minibatch_data[key] = minibatch_data[key].to(device)
-            else:
-                minibatch_data[key] = torch.tensor(minibatch_data[key],device=device)
+        # Convert the input data to torch tensors on the compute device
+        if device is not None and device != self._transfer.device:
+            return device_transfer.device_transfer(
+                device     = device,
+                image_mode = self.args.image_mode,
+                pin_memory = self.args.pin_memory)(minibatch_data)
 
-        return minibatch_data
+        return self._transfer(minibatch_data)
 
 
     def stop(self):
         # Mostly, this is just turning off the io:
-        # self.larcv_fetcher.stop()
-        pass
+        self.larcv_fetcher.stop()
+        if self._inference_writer is not None:
+            self._inference_writer.close()
+        if self._checkpointer is not None:
+            self._checkpointer.close()
+            self._checkpointer = None
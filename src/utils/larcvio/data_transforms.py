@@ -1,6 +1,6 @@
 import numpy
 import torch
-from torch_geometric.data import Data
+from torch_geometric.data import Batch
 
 '''
 This is a not torch-free file that exists to massage data
@@ -107,41 +107,92 @@ def larcvsparse_to_scnsparse_2d(input_array):
     return output_list
 
 
-def larcvsparse_to_scnsparse_3d(input_array):
-    # This format converts the larcv sparse format to
-    # the tuple format required for sparseconvnet
+class sparse_compactor(object):
+    '''
+    Single pass compaction of padded larcv 3D batches into the
+    (coords int64, features float32, batch_size) tuple for sparseconvnet.
 
-    # First, we can split off the features (which is the pixel value)
-    # and the indexes (which is everythin else)
+    One boolean mask over the values and one gather of the filled rows do all
+    the work, and the results are written into output buffers that are reused
+    across calls (and only grow when a batch has more voxels than any before).
 
-    n_dims = input_array.shape[-1]
+    The returned arrays are views into those buffers, so they are only valid
+    until the buffer comes around again: n_buffers must be larger than the
+    number of converted batches alive at once (for example, the prefetch
+    queue depth plus the batch in use).
+    '''
 
-    split_tensors = numpy.split(input_array, n_dims, axis=-1)
+    def __init__(self, n_buffers=1):
+        self._buffers = [ None ] * n_buffers
+        self._index   = 0
 
+    def _next_buffers(self, n_voxels, n_dims, mask_size):
 
-    # To map out the non_zero locations now is easy:
-    non_zero_inds = numpy.where(split_tensors[-1] != -999)
+        buffers = self._buffers[self._index]
+        self._index = (self._index + 1) % len(self._buffers)
 
-    # The batch dimension is just the first piece of the non-zero indexes:
-    batch_size  = input_array.shape[0]
-    batch_index = non_zero_inds[0]
+        if buffers is None or buffers['gather'].shape[0] < n_voxels \
+            or buffers['gather'].shape[1] != n_dims:
+            # Grow with some headroom to avoid reallocating for every larger batch:
+            capacity = int(1.25 * n_voxels) + 1
+            buffers = {
+                'gather'   : numpy.empty((capacity, n_dims), dtype=numpy.float32),
+                'coords'   : numpy.empty((capacity, n_dims), dtype=numpy.int64),
+                'features' : numpy.empty((capacity, 1), dtype=numpy.float32),
+                'mask'     : buffers['mask'] if buffers is not None else None,
+            }
+            self._buffers[self._index - 1] = buffers
 
-    # Getting the voxel values (features) is also straightforward:
-    features = numpy.expand_dims(split_tensors[-1][non_zero_inds],axis=-1)
+        if buffers['mask'] is None or buffers['mask'].shape[0] != mask_size:
+            buffers['mask'] = numpy.empty(mask_size, dtype=bool)
 
-    # Lastly, we need to stack up the coordinates, which we do here:
-    dimension_list = []
-    for i in range(len(split_tensors) - 1):
-        dimension_list.append(split_tensors[i][non_zero_inds])
+        return buffers
 
-    # Tack on the batch index to this list for stacking:
-    dimension_list.append(batch_index)
+    def scnsparse_3d(self, input_array):
 
-    # And stack this into one numpy array:
-    dimension = numpy.stack(dimension_list, axis=-1)
+        batch_size = input_array.shape[0]
+        n_dims     = input_array.shape[-1]
 
-    output_array = (dimension, features, batch_size,)
-    return output_array
+        # View the batch as one long list of voxels, [B * N_planes * Max_voxels, N_dims]:
+        flat = input_array.reshape(-1, n_dims)
+        voxels_per_event = flat.shape[0] // batch_size
+
+        # The one mask:
+        buffers = self._next_buffers(0, n_dims, flat.shape[0])
+        numpy.not_equal(flat[:,-1], -999, out=buffers['mask'])
+        index = numpy.flatnonzero(buffers['mask'])
+        n_voxels = len(index)
+
+        if buffers['gather'].shape[0] < n_voxels:
+            # Step back and grow this slot's buffers:
+            self._index = (self._index - 1) % len(self._buffers)
+            buffers = self._next_buffers(n_voxels, n_dims, flat.shape[0])
+
+        # The one gather:
+        gathered = buffers['gather'][:n_voxels]
+        numpy.take(flat, index, axis=0, out=gathered)
+
+        coords   = buffers['coords'][:n_voxels]
+        features = buffers['features'][:n_voxels]
+
+        # Spatial coordinates, then the batch index in the last column:
+        coords[:,:-1] = gathered[:,:-1]
+        numpy.floor_divide(index, voxels_per_event, out=coords[:,-1])
+        features[:,0] = gathered[:,-1]
+
+        return (coords, features, batch_size,)
+
+
+def larcvsparse_to_scnsparse_3d(input_array, compactor=None):
+    # This format converts the larcv sparse format to
+    # the tuple format required for sparseconvnet
+
+    # Pass a sparse_compactor to reuse its output buffers across calls,
+    # otherwise a fresh set is allocated for this call.
+    if compactor is None:
+        compactor = sparse_compactor()
+
+    return compactor.scnsparse_3d(input_array)
 
 
 def larcvsparse_to_dense_3d(input_array, dense_shape):
@@ -176,46 +227,91 @@ def larcvsparse_to_dense_3d(input_array, dense_shape):
 
 def larcvsparse_to_pointcloud_3d(input_array):
 
-    # This function iterates over each batch to create a pointcloud from each batch sample
-    # Each point cloud will generate a torch-geometric Data object using the Data() class
-    # The point clouds are appended to a data list which can be input to a Batch.from_data_list object
-
-    # print(input_array.shape)
-
-    data_pre_batch = []
-    # Loop over minibatch index:
-    for i in range(input_array.shape[0]):
-        x_coords   = input_array[i,0,:,0]
-        y_coords   = input_array[i,0,:,1]
-        z_coords   = input_array[i,0,:,2]
-        val_coords = input_array[i,0,:,3]
-        voxel_index = numpy.where(val_coords != -999)
-        values  = val_coords[voxel_index]
-        x_values = x_coords[voxel_index]
-        y_values = y_coords[voxel_index]
-        z_values = z_coords[voxel_index]
-
-        # print(input_array[i,0,0,:])
-        # print(input_array[i,0,1,:])
-        # print(values.shape)
-
-        zeroes_help = torch.zeros(values.shape[0],1)
-        values_temp = torch.Tensor(numpy.transpose(numpy.array(values)))
-        # print(values_temp.shape)
-        # print(zeroes_help.shape)
-        zeroes_help[:,0] = values_temp
-        point_temp = torch.Tensor(numpy.transpose(numpy.array([x_values,y_values,z_values])))
-
-        # print(point_temp.shape)
-        # print(point_temp[0:2])
-
-        # PointNet takes the features from the X array and the nodes positions from the pos argument
-        #  Make sure that both x and pos are torch tensors
-        data_temp_b = Data(x=zeroes_help,pos=point_temp)
-
-        # When we have isolated nodes it is necessary to set the number of nodes manually
-        data_temp_b.num_nodes = point_temp.shape[0]
-        data_pre_batch.append(data_temp_b)
-
-    # print(len(data_pre_batch))
-    return data_pre_batch
+    # This function builds a torch-geometric Batch for the whole minibatch at once.
+    # One mask over the values picks out every filled voxel; since numpy.where
+    # returns them ordered by minibatch index, the points of each event are
+    # already contiguous and the batch / ptr vectors follow from the counts.
+
+    batch_size = input_array.shape[0]
+
+    val_coords = input_array[:,0,:,3]
+    batch_index, voxel_index = numpy.where(val_coords != -999)
+
+    # Gather every filled voxel as one [N, 4] array of (x, y, z, value):
+    voxels = input_array[batch_index, 0, voxel_index]
+
+    # PointNet takes the features from the X array and the nodes positions from the pos argument
+    x   = torch.from_numpy(numpy.ascontiguousarray(voxels[:,3:4], dtype=numpy.float32))
+    pos = torch.from_numpy(numpy.ascontiguousarray(voxels[:,0:3], dtype=numpy.float32))
+
+    counts = numpy.bincount(batch_index, minlength=batch_size)
+    ptr    = numpy.zeros(batch_size + 1, dtype=numpy.int64)
+    numpy.cumsum(counts, out=ptr[1:])
+
+    return Batch(
+        x     = x,
+        pos   = pos,
+        batch = torch.from_numpy(batch_index.astype(numpy.int64)),
+        ptr   = torch.from_numpy(ptr),
+    )
+
+
+'''
+The functions below take the ragged image format served by voxel_cache.reader,
+a tuple of (coords [N, dim], values [N], counts [B, N_planes]), where the voxels
+are ordered by (event, plane).  No padding is involved, so there is nothing to mask.
+'''
+
+def _ragged_indexes(counts):
+    # Batch and plane index of every voxel, from the per (event, plane) counts:
+    batch_size, n_planes = counts.shape
+    flat_counts = counts.ravel()
+    batch_index = numpy.repeat(numpy.repeat(numpy.arange(batch_size), n_planes), flat_counts)
+    plane_index = numpy.repeat(numpy.tile(numpy.arange(n_planes), batch_size), flat_counts)
+    return batch_index, plane_index
+
+def ragged_to_scnsparse_2d(ragged):
+
+    coords, values, counts = ragged
+
+    batch_size = counts.shape[0]
+    batch_index, plane_index = _ragged_indexes(counts)
+
+    # Same column order as larcvsparse_to_scnsparse_2d: (plane, y, x, batch)
+    dimension = numpy.stack([plane_index, coords[:,1], coords[:,0], batch_index], axis=-1)
+    features  = numpy.asarray(values, dtype=numpy.float32).reshape(-1, 1)
+
+    return [dimension, features, batch_size]
+
+def ragged_to_scnsparse_3d(ragged):
+
+    coords, values, counts = ragged
+
+    batch_size = counts.shape[0]
+    batch_index, _ = _ragged_indexes(counts)
+
+    dimension = numpy.empty((len(values), 4), dtype=numpy.int64)
+    dimension[:,0:3] = coords
+    dimension[:,3]   = batch_index
+
+    features = numpy.asarray(values, dtype=numpy.float32).reshape(-1, 1)
+
+    return (dimension, features, batch_size,)
+
+def ragged_to_pointcloud_3d(ragged):
+
+    coords, values, counts = ragged
+
+    batch_size = counts.shape[0]
+    batch_index, _ = _ragged_indexes(counts)
+
+    ptr = numpy.zeros(batch_size + 1, dtype=numpy.int64)
+    numpy.cumsum(counts.sum(axis=-1), out=ptr[1:])
+
+    # (numpy.array copies here: the cache arrays may be read-only memory maps)
+    return Batch(
+        x     = torch.from_numpy(numpy.array(values, dtype=numpy.float32).reshape(-1, 1)),
+        pos   = torch.from_numpy(numpy.array(coords, dtype=numpy.float32)),
+        batch = torch.from_numpy(batch_index),
+        ptr   = torch.from_numpy(ptr),
+    )
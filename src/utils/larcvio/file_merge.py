@@ -0,0 +1,190 @@
+import os
+import time
+import concurrent.futures
+
+import numpy
+import h5py
+
+'''
+Merge many larcv files into a few, in parallel.
+
+Merges run as a k-ary tree in a local process pool: the leaves each read up
+to `fan_in` input files and write the entries of one split, then every level
+merges groups of `fan_in` outputs of the level below until one file per
+split is left.  A merge that fails is retried, and its partial output is
+removed first.
+
+Events are assigned to a split (for example train and test) by a hash of
+their event ID, so the split of an event doesn't depend on which file it is
+in, the file order or the number of workers.
+'''
+
+
+def event_hash(event_ids, seed=0):
+    '''A reproducible 64 bit hash of each event ID (run, subrun, event)'''
+
+    if event_ids.dtype.names is not None:
+        fields = [ event_ids[name] for name in event_ids.dtype.names ]
+    else:
+        fields = [ event_ids.reshape(len(event_ids), -1)[:,i] for i in range(event_ids.reshape(len(event_ids), -1).shape[-1]) ]
+
+    h = numpy.full(len(event_ids), seed, dtype=numpy.uint64)
+    for field in fields:
+        # splitmix64, folding in one field at a time:
+        h ^= field.astype(numpy.uint64)
+        h += numpy.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> numpy.uint64(30)
+        h *= numpy.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> numpy.uint64(27)
+        h *= numpy.uint64(0x94D049BB133111EB)
+        h ^= h >> numpy.uint64(31)
+
+    return h
+
+
+def split_of(event_ids, fractions, seed=0):
+    '''Index of the split each event falls in, for splits with the given fractions'''
+
+    # The top 53 bits as a uniform number in [0, 1):
+    u = (event_hash(event_ids, seed) >> numpy.uint64(11)).astype(numpy.float64) / 2.**53
+    return numpy.searchsorted(numpy.cumsum(fractions)[:-1], u, side='right')
+
+
+def _merge(input_files, output_file, split=None, fractions=None, seed=0):
+    '''Copy the (selected) entries of input_files into output_file
+
+    With split set, only the events that hash into that split are copied.
+    Returns the number of entries written, or None if there were none (and
+    no file was written).
+    '''
+
+    from larcv import larcv
+
+    entries = None
+    if split is not None:
+        selected = []
+        for f in input_files:
+            with h5py.File(f, 'r') as _f:
+                selected.append(split_of(_f['Events']['event_id'][:], fractions, seed) == split)
+        entries = numpy.flatnonzero(numpy.concatenate(selected))
+        if len(entries) == 0:
+            return None
+
+    # In kBOTH mode, every product of an entry that is read is saved with it:
+    io = larcv.IOManager(larcv.IOManager.kBOTH)
+    for f in input_files:
+        io.add_in_file(f)
+    io.set_out_file(output_file)
+    io.initialize()
+
+    if entries is None:
+        entries = range(io.get_n_entries())
+
+    for entry in entries:
+        io.read_entry(int(entry), True)
+        io.save_entry()
+
+    io.finalize()
+
+    return len(entries)
+
+
+def _run_merge(input_files, output_file, split, fractions, seed, retries):
+    '''Run one merge in a worker, with retries, and time it'''
+
+    input_bytes = sum(os.path.getsize(f) for f in input_files)
+
+    for attempt in range(retries + 1):
+        start = time.time()
+        try:
+            n_entries = _merge(input_files, output_file, split, fractions, seed)
+            return output_file, n_entries, input_bytes, time.time() - start, attempt
+        except Exception as e:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            if attempt == retries:
+                raise Exception(f"Merging into {output_file} failed after {retries + 1} attempts: {e}")
+
+
+def tree_merge(input_files, outputs, fractions=None, fan_in=8, n_workers=None,
+               tmp_dir=None, seed=0, retries=2, keep_intermediate=False):
+    '''Merge input_files into one file per split, as a k-ary tree
+
+    outputs is the list of output files, one per split, and fractions the
+    fraction of events in each split (one output needs no fractions).
+    Returns the number of entries written to each output.
+    '''
+
+    if fractions is None:
+        if len(outputs) != 1:
+            raise Exception("Merging into several outputs needs the fraction of events in each")
+        fractions = [1.0]
+    if len(fractions) != len(outputs):
+        raise Exception("Need one fraction per output file")
+    if fan_in < 2:
+        raise Exception("The merge fan in has to be at least 2")
+
+    fractions = numpy.asarray(fractions, dtype=numpy.float64)
+    fractions = fractions / fractions.sum()
+
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(outputs[0]))
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    n_entries = [0] * len(outputs)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as pool:
+
+        # The leaves split the input files, the levels above only merge:
+        leaves  = [ input_files[i:i+fan_in] for i in range(0, len(input_files), fan_in) ]
+        current = [ leaves for s in outputs ]
+        level   = 0
+
+        while True:
+            futures = {}
+            written = [ [] for s in outputs ]
+            for s, groups in enumerate(current):
+                prefix = os.path.join(tmp_dir, os.path.basename(outputs[s]).replace('.h5', ''))
+                for i, group in enumerate(groups):
+                    if level > 0 and len(group) == 1:
+                        # Nothing to merge it with, carry it up to the next level:
+                        written[s].append((i, group[0]))
+                        continue
+                    output_file = f"{prefix}.level{level}_{i}.h5"
+                    split = s if level == 0 and len(outputs) > 1 else None
+                    future = pool.submit(_run_merge, group, output_file, split, fractions, seed, retries)
+                    futures[future] = (s, i, group)
+
+            for future in concurrent.futures.as_completed(futures):
+                s, i, group = futures[future]
+                output_file, n, input_bytes, elapsed, attempt = future.result()
+
+                if level > 0 and not keep_intermediate:
+                    for f in group:
+                        os.remove(f)
+
+                if n is None:
+                    continue
+                written[s].append((i, output_file))
+                n_entries[s] = n
+                retried = f", after {attempt} retries" if attempt > 0 else ""
+                print(f"Merged {len(group)} files into {output_file}: {n} entries, "
+                      f"{input_bytes / 2.**20 / elapsed:.1f} MB/s{retried}")
+
+            # Keep the order of the tree stable, whatever order the merges finished in:
+            written = [ [ f for i, f in sorted(w) ] for w in written ]
+
+            if all(len(w) <= 1 for w in written):
+                break
+
+            current = [ [ w[i:i+fan_in] for i in range(0, len(w), fan_in) ] for w in written ]
+            level += 1
+
+    for s, output in enumerate(outputs):
+        if len(written[s]) == 0:
+            print(f"No events for {output}")
+            n_entries[s] = 0
+            continue
+        os.replace(written[s][0], output)
+
+    return n_entries
@@ -0,0 +1,163 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import concurrent.futures
+
+import numpy
+import h5py
+
+from . import voxel_cache
+
+'''
+Class frequencies of the labels of a sample, for loss weights.
+
+The counts of each file are computed once, in chunks, and cached in a sidecar
+next to it (<file>.label_stats.json) keyed by a fingerprint of the file, so
+they are recomputed only when the file changes.  Files without a cached
+count are read in parallel.
+
+larcv files are read with h5py: the label of an entry is the pdg of the first
+particle of its label producer (which is what BatchFillerPIDLabel fills), and
+only the extents and the pdg column are read.  Voxel caches store the labels
+one hot, and are counted from those.
+'''
+
+_sidecar_suffix = ".label_stats.json"
+
+_chunk_size = 1 << 20
+
+
+def label_classes(label_mode):
+    '''{label key : (particle producer, number of classes)}, matching io_templates.gen_label_filler'''
+    if label_mode == 'all':
+        return { 'label' : ('all', 36) }
+    return { 'label_' + name : (name + 'ID', n) for name, n in zip(['neut', 'prot', 'cpi', 'npi'], [3, 3, 2, 2]) }
+
+
+def fingerprint(input_file):
+    '''A cheap content hash: the size, and the first and last MB of the file (or the cache metadata)'''
+
+    input_file = str(input_file)
+    if voxel_cache.is_cache(input_file):
+        input_file = os.path.join(input_file, voxel_cache._meta_file)
+
+    size = os.path.getsize(input_file)
+    h = hashlib.sha1(str(size).encode())
+    with open(input_file, 'rb') as _f:
+        h.update(_f.read(1 << 20))
+        if size > 2 << 20:
+            _f.seek(-(1 << 20), os.SEEK_END)
+            h.update(_f.read(1 << 20))
+    return h.hexdigest()
+
+
+def count_file(input_file, label_mode):
+    '''Number of entries of each class, for each label key, in one file'''
+
+    classes = label_classes(label_mode)
+    counts  = {}
+
+    if voxel_cache.is_cache(input_file):
+        cache = voxel_cache.reader(input_file, mmap=True)
+        for key, n_classes in cache.meta['labels'].items():
+            labels = cache.labels[key]
+            c = numpy.zeros(n_classes, dtype=numpy.int64)
+            for start in range(0, labels.shape[0], _chunk_size):
+                c += numpy.bincount(numpy.argmax(labels[start:start + _chunk_size], axis=-1), minlength=n_classes)[:n_classes]
+            counts[key] = c.tolist()
+        return counts
+
+    with h5py.File(input_file, 'r') as _f:
+        for key, (producer, n_classes) in classes.items():
+            group     = _f['Data'][f'particle_{producer}_group']
+            extents   = group['extents']
+            particles = group['particles']
+
+            c = numpy.zeros(n_classes, dtype=numpy.int64)
+            for start in range(0, extents.shape[0], _chunk_size):
+                entry_extents = extents[start:start + _chunk_size]
+                # The fields are (first, N), and entries with no particle have no label:
+                first = entry_extents[entry_extents.dtype.names[0]].astype(numpy.int64)
+                first = first[entry_extents[entry_extents.dtype.names[1]] > 0]
+                if len(first) == 0:
+                    continue
+                # One contiguous read of the pdg column for the whole chunk:
+                pdg = particles.fields('pdg')[first[0]:first[-1] + 1][first - first[0]]
+                # Like the filler, pdgs outside of the class list are skipped:
+                pdg = pdg[(pdg >= 0) & (pdg < n_classes)]
+                c += numpy.bincount(pdg.astype(numpy.int64), minlength=n_classes)
+            counts[key] = c.tolist()
+
+    return counts
+
+
+def _sidecar(input_file):
+    return str(input_file).rstrip('/') + _sidecar_suffix
+
+
+def _load_sidecar(input_file):
+    '''The contents of the sidecar of a file, or None if it's missing or unreadable'''
+
+    try:
+        with open(_sidecar(input_file), 'r') as _f:
+            stats = json.load(_f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stats, dict) or 'fingerprint' not in stats or 'counts' not in stats:
+        return None
+    return stats
+
+
+def _read_cached(input_file, label_mode):
+    '''The cached counts of a file, or None if there are none for this version of it'''
+
+    stats = _load_sidecar(input_file)
+    if stats is None or stats['fingerprint'] != fingerprint(input_file):
+        return None
+    return stats['counts'].get(label_mode)
+
+
+def _count_and_cache(input_file, label_mode):
+    '''count_file, and store the result in the sidecar'''
+
+    key   = fingerprint(input_file)
+    stats = { 'fingerprint' : key, 'counts' : {} }
+    previous = _load_sidecar(input_file)
+    # Keep the counts of the other label mode, unless the file changed:
+    if previous is not None and previous['fingerprint'] == key:
+        stats = previous
+
+    stats['counts'][label_mode] = count_file(input_file, label_mode)
+
+    # The cache is only an optimization, so a read only directory isn't an error:
+    try:
+        with open(_sidecar(input_file) + ".tmp", 'w') as _f:
+            json.dump(stats, _f, indent=2)
+        os.replace(_sidecar(input_file) + ".tmp", _sidecar(input_file))
+    except OSError:
+        pass
+
+    return stats['counts'][label_mode]
+
+
+def label_counts(input_files, label_mode, n_workers=None):
+    '''Number of entries of each class, for each label key, summed over input_files'''
+
+    per_file = [ _read_cached(f, label_mode) for f in input_files ]
+    missing  = [ f for f, c in zip(input_files, per_file) if c is None ]
+
+    if len(missing) == 1:
+        counted = [ _count_and_cache(missing[0], label_mode) ]
+    elif len(missing) > 1:
+        # Spawned, not forked, workers: this runs in the trainer, after torch starts its threads.
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                mp_context=multiprocessing.get_context('spawn')) as pool:
+            counted = list(pool.map(_count_and_cache, missing, [label_mode] * len(missing)))
+    else:
+        counted = []
+
+    counted  = iter(counted)
+    per_file = [ c if c is not None else next(counted) for c in per_file ]
+
+    return { key : numpy.sum([ c[key] for c in per_file ], axis=0).tolist() for key in per_file[0] }
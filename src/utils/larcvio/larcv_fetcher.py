@@ -1,18 +1,82 @@
 import os
+import glob
 import time
+import queue
+import threading
 
 from . import data_transforms
 from . import io_templates
+from . import voxel_cache
 import tempfile
 
 import numpy
 import h5py
 
-from torch_geometric.data import Batch
+def resolve_input_files(input_file):
+    '''Expand a file, a glob, a directory of .h5 files, or a list of those into a list of files'''
+
+    if isinstance(input_file, (list, tuple)):
+        return [ f for i in input_file for f in resolve_input_files(i) ]
+
+    input_file = str(input_file)
+
+    if glob.has_magic(input_file):
+        files = sorted(glob.glob(input_file))
+        if len(files) == 0:
+            raise Exception(f"No files match {input_file}")
+        return files
+
+    if not os.path.exists(input_file):
+        raise Exception(f"File {input_file} not found")
+
+    if os.path.isdir(input_file) and not voxel_cache.is_cache(input_file):
+        files = sorted(glob.glob(os.path.join(input_file, "*.h5")))
+        if len(files) == 0:
+            raise Exception(f"No .h5 files in {input_file}")
+        return files
+
+    return [input_file]
+
+
+def count_entries(input_file):
+    '''Number of events in a larcv file or voxel cache, or the total over a list of them'''
+
+    if isinstance(input_file, (list, tuple)):
+        return sum(count_entries(f) for f in input_file)
+    if voxel_cache.is_cache(input_file):
+        return voxel_cache.reader(input_file, mmap=True).size()
+    with h5py.File(input_file, 'r') as _f:
+        return _f['Events']['event_id'].shape[0]
+
+
+def shard_files(input_files, n_entries, rank, world_size):
+    '''Assign whole files to ranks, balancing the number of entries
+
+    Files go largest first to the rank with the fewest entries so far, which
+    every rank computes identically.  Each rank's files stay in input order.
+    '''
+
+    load     = [0] * world_size
+    assigned = [[] for r in range(world_size)]
+    for i in sorted(range(len(input_files)), key=lambda i : (-n_entries[i], i)):
+        target = min(range(world_size), key=lambda r : (load[r], r))
+        assigned[target].append(i)
+        load[target] += n_entries[i]
+
+    return [ input_files[i] for i in sorted(assigned[rank]) ]
+
+
+def _rank_and_size():
+    import torch.distributed as dist
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    from mpi4py import MPI
+    return MPI.COMM_WORLD.Get_rank(), MPI.COMM_WORLD.Get_size()
+
 
 class larcv_fetcher(object):
 
-    def __init__(self, mode, distributed, image_mode, label_mode, input_dimension, seed=None):
+    def __init__(self, mode, distributed, image_mode, label_mode, input_dimension, seed=None, prefetch_depth=0, backend="larcv"):
 
         if mode not in ['train', 'inference', 'iotest']:
             raise Exception("Larcv Fetcher can't handle mode ", mode)
@@ -23,7 +87,21 @@ class larcv_fetcher(object):
         else:
             random_access_mode = "random_blocks"
 
-        if distributed:
+        if backend not in ['larcv', 'mmap']:
+            raise Exception("Larcv Fetcher can't handle backend ", backend)
+
+        self.backend = backend
+
+        self.distributed         = distributed
+        self._seed               = seed
+        self._random_access_mode = random_access_mode
+
+        if backend == "mmap":
+            # Memory mapped voxel caches, with no larcv involved:
+            from . import mmap_interface
+            self._larcv_interface = mmap_interface.queue_interface(
+                random_access_mode=random_access_mode, seed=seed, distributed=distributed)
+        elif distributed:
             from larcv import distributed_queue_interface
             self._larcv_interface = distributed_queue_interface.queue_interface(
                 random_access_mode=random_access_mode, seed=seed)
@@ -37,26 +115,95 @@ class larcv_fetcher(object):
         self.label_mode      = label_mode
         self.input_dimension = input_dimension
 
+        # Number of fully converted minibatches to hold ahead of time, per sample.
+        # 0 disables the background prefetch and fetches on the calling thread.
+        self.prefetch_depth  = prefetch_depth
+        self._prefetch_queues  = {}
+        self._prefetch_threads = {}
+        self._prefetch_stop    = {}
+
+        # Reusable output buffers for the sparse 3D conversion, one ring per sample.
+        # A converted batch can sit in the prefetch queue, be in use by the
+        # current step, be preloaded for the next one, or be in conversion:
+        self._compactors = {}
+        self._n_compactor_buffers = prefetch_depth + 3
+
+        self._batch_sizes = {}
+
+        # Samples read from a per rank share of their files have their own,
+        # non distributed, interface:
+        self._interfaces = {}
+
         self.writer     = None
 
 
     def __del__(self):
+        self.stop()
         if self.writer is not None:
             self.writer.finalize()
 
+    def stop(self):
+        '''Shut down any background prefetch threads'''
+        for name, thread in self._prefetch_threads.items():
+            self._prefetch_stop[name].set()
+            thread.join(timeout=1.0)
+        self._prefetch_threads = {}
+
 
 
-    def prepare_sample(self, name, input_file, batch_size, color=None, start_index = 0):
+    def prepare_sample(self, name, input_file, batch_size, color=None, start_index = 0, voxel_budget = 0, serial = False):
+        '''Prepare a sample to read minibatches from, and return its number of entries
 
+        A serial sample is read in order, on every rank, from an interface of
+        its own and without prefetching, so it can be rewound to any entry.
+        '''
 
+        # First, verify the files exist (and expand any globs or directories):
+        input_files = resolve_input_files(input_file)
 
-        # First, verify the files exist:
-        if not os.path.exists(input_file):
-            raise Exception(f"File {input_file} not found")
+        self._batch_sizes[name] = batch_size
+
+        # Preprocessed voxel caches skip larcv (and its padding) entirely:
+        if self.backend == "mmap":
+            if len(input_files) != 1:
+                raise Exception("The mmap backend reads one voxel cache, build it from all of the files with bin/build_voxel_cache.py")
+            if serial:
+                from . import mmap_interface
+                self._interfaces[name] = mmap_interface.queue_interface(
+                    random_access_mode="serial_access", seed=self._seed, distributed=False)
+            return self._prepare_cache(name, input_files[0], batch_size, color, start_index, voxel_budget, serial)
+
+        if voxel_budget > 0:
+            raise Exception("Batching by voxel budget needs the mmap backend, larcv minibatches have a fixed size")
+
+        for f in input_files:
+            if voxel_cache.is_cache(f):
+                raise Exception(f"{f} is a voxel cache, read it with the mmap backend")
+
+        # In distributed mode with at least as many files as ranks, each rank
+        # reads only its own whole files.  Otherwise, every rank opens all of
+        # the files and the distributed interface splits the entries.
+        n_entries = None
+        if serial:
+            from larcv import queueloader
+            self._interfaces[name] = queueloader.queue_interface(
+                random_access_mode = "serial_access",
+                seed               = self._seed)
+        elif self.distributed and len(input_files) > 1:
+            rank, world_size = _rank_and_size()
+            if len(input_files) >= world_size:
+                file_entries = [ count_entries(f) for f in input_files ]
+                n_entries    = sum(file_entries)
+                input_files  = shard_files(input_files, file_entries, rank, world_size)
+
+                from larcv import queueloader
+                self._interfaces[name] = queueloader.queue_interface(
+                    random_access_mode = self._random_access_mode,
+                    seed               = None if self._seed is None else self._seed + rank)
 
         config = io_templates.dataset_io(
                 name        = name,
-                input_file  = input_file,
+                input_file  = input_files,
                 image_dim   = self.input_dimension,
                 label_mode  = self.label_mode)
 
@@ -96,17 +243,24 @@ class larcv_fetcher(object):
 
 
 
-        self._larcv_interface.prepare_manager(name, io_config, batch_size, data_keys, color=color)
+        self._interface(name).prepare_manager(name, io_config, batch_size, data_keys, color=color)
         os.unlink(main_file.name)
 
 
         if self.mode == "inference":
-            self._larcv_interface.set_next_index(name, start_index)
+            self._interface(name).set_next_index(name, start_index)
 
-        while self._larcv_interface.is_reading(name):
+        while self._interface(name).is_reading(name):
             time.sleep(0.1)
 
-        return self._larcv_interface.size(name)
+        if self.prefetch_depth > 0 and not serial:
+            self.start_prefetch(name)
+
+        # Sharded samples report the size of the whole sample, like the distributed interface:
+        if n_entries is not None:
+            return n_entries
+
+        return self._interface(name).size(name)
 
 
 #############################################################################
@@ -133,8 +287,86 @@ class larcv_fetcher(object):
         #     except:
         #         pass
 
+    def _prepare_cache(self, name, input_file, batch_size, color, start_index, voxel_budget, serial):
+
+        self._interface(name).prepare_manager(name, str(input_file), batch_size, color=color,
+            voxel_budget=voxel_budget)
+
+        if self.label_mode == 'all':
+            self.keyword_label = 'label'
+        else:
+            self.keyword_label = self._interface(name).label_keys(name)
+
+        if self.mode == "inference":
+            self._interface(name).set_next_index(name, start_index)
+
+        if self.prefetch_depth > 0 and not serial:
+            self.start_prefetch(name)
+
+        return self._interface(name).size(name)
+
+    def _interface(self, name):
+        return self._interfaces.get(name, self._larcv_interface)
+
+    def rewind(self, name, index):
+        '''Continue reading a serial sample from entry index'''
+        if name in self._prefetch_queues:
+            raise Exception(f"Can't rewind {name}, it isn't a serial sample")
+        self._interface(name).set_next_index(name, index)
+        while self._interface(name).is_reading(name):
+            time.sleep(0.01)
+
+    def mean_batch_size(self, name):
+        '''Average number of events per minibatch of a sample'''
+        if self.backend == "mmap":
+            return self._interface(name).mean_batch_size(name)
+        return self._batch_sizes[name]
+
+    def start_prefetch(self, name):
+        '''Start a worker thread that keeps `prefetch_depth` converted batches queued
+
+        Once started, the worker is the only caller of the larcv interface for
+        this sample, and fetch_next_batch just dequeues.
+        '''
+        if name in self._prefetch_threads:
+            return
+
+        self._prefetch_queues[name] = queue.Queue(maxsize=self.prefetch_depth)
+        self._prefetch_stop[name]   = threading.Event()
+        thread = threading.Thread(
+            target = self._prefetch_worker,
+            args   = (name,),
+            name   = f"larcv_prefetch_{name}",
+            daemon = True)
+        self._prefetch_threads[name] = thread
+        thread.start()
+
+    def _prefetch_worker(self, name):
+
+        prefetch_queue = self._prefetch_queues[name]
+        stop           = self._prefetch_stop[name]
+
+        while not stop.is_set():
+            try:
+                minibatch_data = self._fetch_and_convert(name, pop=True)
+            except Exception as e:
+                # Hand the error to the consumer rather than dying silently:
+                minibatch_data = e
+
+            # Block until there is room, but wake up regularly to check for shutdown:
+            while not stop.is_set():
+                try:
+                    prefetch_queue.put(minibatch_data, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+            # The end of the sample, or an error, is the last thing queued:
+            if minibatch_data is None or isinstance(minibatch_data, Exception):
+                return
+
     def fetch_minibatch_dims(self, name):
-        return self._larcv_interface.fetch_minibatch_dims(name)
+        return self._interface(name).fetch_minibatch_dims(name)
 
     def output_shape(self, name):
 
@@ -150,16 +382,58 @@ class larcv_fetcher(object):
 
     def fetch_next_batch(self, name, force_pop=False):
 
-        metadata=True
+        # With prefetching on, every call returns the next converted batch
+        # off the queue (the worker always pops).
+        if name in self._prefetch_queues:
+            prefetch_queue = self._prefetch_queues[name]
+            while True:
+                try:
+                    minibatch_data = prefetch_queue.get(timeout=1.0)
+                    break
+                except queue.Empty:
+                    # Don't wait forever on a worker that has stopped:
+                    thread = self._prefetch_threads.get(name)
+                    if thread is None or not thread.is_alive():
+                        if not prefetch_queue.empty():
+                            continue
+                        raise Exception(f"The prefetch worker of {name} stopped")
+
+            if minibatch_data is None or isinstance(minibatch_data, Exception):
+                # The worker has exited, so leave the same result for any later call:
+                prefetch_queue.put(minibatch_data)
+                if minibatch_data is not None:
+                    raise minibatch_data
+            return minibatch_data
 
-        pop = True
-        if not force_pop:
-            pop = False
+        return self._fetch_and_convert(name, pop=force_pop)
+
+    def _fetch_and_convert(self, name, pop):
+
+        if self.backend == "mmap":
+            minibatch_data = self._interface(name).fetch_minibatch_data(name, pop=pop)
+            if pop:
+                self._interface(name).prepare_next(name)
+            minibatch_data['image'] = self._convert_ragged_image(minibatch_data['image'])
+            return minibatch_data
+
+        minibatch_data = self.fetch_raw_batch(name, pop)
+
+        # If the returned data is None, return none and don't load more:
+        if minibatch_data is None:
+            return minibatch_data
 
+        minibatch_data['image'] = self._convert_image(minibatch_data['image'], name)
 
-        minibatch_data = self._larcv_interface.fetch_minibatch_data(name,
+        return minibatch_data
+
+    def fetch_raw_batch(self, name, pop):
+        '''Fetch the next batch from larcv, reshaped but still in the padded larcv format'''
+
+        metadata=True
+
+        minibatch_data = self._interface(name).fetch_minibatch_data(name,
             pop=pop,fetch_meta_data=metadata)
-        minibatch_dims = self._larcv_interface.fetch_minibatch_dims(name)
+        minibatch_dims = self._interface(name).fetch_minibatch_dims(name)
 
         # If the returned data is None, return none and don't load more:
         if minibatch_data is None:
@@ -167,7 +441,7 @@ class larcv_fetcher(object):
 
         # This brings up the next data to current data
         if pop:
-            self._larcv_interface.prepare_next(name)
+            self._interface(name).prepare_next(name)
 
         # Reshape as needed from larcv:
         for key in minibatch_data:
@@ -183,29 +457,49 @@ class larcv_fetcher(object):
         #     minibatch_data["label_prot"] = minibatch_data.pop("aux_label_prot")
         #     minibatch_data["label_neut"] = minibatch_data.pop("aux_label_neut")
 
+        return minibatch_data
+
+    def _convert_image(self, image, name=None):
 
         # Here, do some massaging to convert the input data to another format, if necessary:
         if self.image_mode == 'dense':
             # Need to convert sparse larcv into a dense numpy array:
             if self.input_dimension == 3:
-                minibatch_data['image'] = data_transforms.larcvsparse_to_dense_3d(minibatch_data['image'])
+                image = data_transforms.larcvsparse_to_dense_3d(image)
             else:
-                minibatch_data['image'] = data_transforms.larcvsparse_to_dense_2d(minibatch_data['image'])
+                image = data_transforms.larcvsparse_to_dense_2d(image)
         elif self.image_mode == 'sparse':
             # Have to convert the input image from dense to sparse format:
             if self.input_dimension == 3:
-                minibatch_data['image'] = data_transforms.larcvsparse_to_scnsparse_3d(minibatch_data['image'])
+                if name not in self._compactors:
+                    self._compactors[name] = data_transforms.sparse_compactor(self._n_compactor_buffers)
+                image = data_transforms.larcvsparse_to_scnsparse_3d(image, self._compactors[name])
             else:
-                minibatch_data['image'] = data_transforms.larcvsparse_to_scnsparse_2d(minibatch_data['image'])
+                image = data_transforms.larcvsparse_to_scnsparse_2d(image)
         elif self.image_mode == 'graph':
-                # Here we use Batch.from_data_list to create a bacth object from a lit of torch geometric Data objects
-                minibatch_data['image'] = data_transforms.larcvsparse_to_pointcloud_3d(minibatch_data['image'])
-                minibatch_data['image'] = Batch.from_data_list(minibatch_data['image'])
+                # This builds the torch geometric Batch object directly, with no per-event Data objects
+                image = data_transforms.larcvsparse_to_pointcloud_3d(image)
 
         else:
             raise Exception("Image Mode not recognized")
 
-        return minibatch_data
+        return image
+
+
+    def _convert_ragged_image(self, image):
+
+        # Same as _convert_image, for the ragged format of a voxel cache:
+        if self.image_mode == 'sparse':
+            if self.input_dimension == 3:
+                image = data_transforms.ragged_to_scnsparse_3d(image)
+            else:
+                image = data_transforms.ragged_to_scnsparse_2d(image)
+        elif self.image_mode == 'graph':
+            image = data_transforms.ragged_to_pointcloud_3d(image)
+        else:
+            raise Exception(f"Image Mode {self.image_mode} not supported from a voxel cache")
+
+        return image
 
 
     def prepare_writer(self, input_file, output_file):
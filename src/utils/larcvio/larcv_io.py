@@ -9,6 +9,15 @@ a full configuration string, or even a temp file.
 '''
 
 
+def file_list_str(value):
+    # InputFiles takes one file or a list of them, formatted as a list:
+    if isinstance(value, (list, tuple)):
+        files = value
+    else:
+        files = [value]
+    return "[{}]".format(",".join(["\"{}\"".format(f) for f in files]))
+
+
 class ProcessConfig(object):
 
     def __init__(self, proc_name, proc_type):
@@ -123,10 +132,10 @@ class IOManagerConfig(object):
 
         for param in self._params:
             if param == 'InputFiles':
-                output_str += "{indent}{param}: [\"{value}\"]\n".format(
+                output_str += "{indent}{param}: {value}\n".format(
                     indent = " "*indent_level,
                     param  = param,
-                    value  = self._params[param])
+                    value  = file_list_str(self._params[param]))
             else:
                 output_str += "{indent}{param}: {value} \n".format(
                     indent = " "*indent_level,
@@ -218,10 +227,10 @@ class ThreadIOConfig(CoreConfig):
 
         for param in self._params:
             if param == 'InputFiles':
-                output_str += "{indent}{param}: [\"{value}\"]\n".format(
+                output_str += "{indent}{param}: {value}\n".format(
                     indent = " "*indent_level,
                     param  = param,
-                    value  = self._params[param])
+                    value  = file_list_str(self._params[param]))
             else:
                 output_str += "{indent}{param}: {value} \n".format(
                     indent = " "*indent_level,
@@ -0,0 +1,188 @@
+import zlib
+
+import numpy
+
+from . import voxel_cache
+
+'''
+A larcv-free data backend for larcv_fetcher, serving minibatches from a voxel
+cache (see voxel_cache.py) through numpy memory maps.
+
+It mirrors the parts of the larcv queueloader / distributed_queue_interface API
+that the fetcher uses.  Every minibatch is a block of consecutive events, so
+the voxel and label arrays it returns are views into the memory map rather
+than copies.  Because the cache is only ever mapped read-only, every rank on a
+node that reads the same cache shares one copy of it in the page cache.
+'''
+
+
+class queue_interface(object):
+
+    def __init__(self, random_access_mode="random_blocks", seed=None, distributed=False):
+
+        if random_access_mode not in ['random_blocks', 'serial_access']:
+            raise Exception(f"mmap interface can't handle random access mode {random_access_mode}")
+
+        self._random_access_mode = random_access_mode
+
+        # In distributed mode, each rank reads its own share of the blocks:
+        if distributed:
+            # Every rank has to draw the same block order to split it without overlap:
+            if seed is None:
+                seed = numpy.random.SeedSequence().entropy
+            import torch.distributed as dist
+            if dist.is_available() and dist.is_initialized():
+                # Use the torch process group when there is one (DDP):
+                self._rank       = dist.get_rank()
+                self._world_size = dist.get_world_size()
+                seed = [ seed ]
+                dist.broadcast_object_list(seed, src=0)
+                seed = seed[0]
+            else:
+                from mpi4py import MPI
+                self._rank       = MPI.COMM_WORLD.Get_rank()
+                self._world_size = MPI.COMM_WORLD.Get_size()
+                seed = MPI.COMM_WORLD.bcast(seed, root=0)
+        else:
+            self._rank       = 0
+            self._world_size = 1
+
+        # Each sample draws from its own generator (see prepare_manager):
+        self._seed   = seed
+        self._random = {}
+
+        self._readers      = {}
+        self._batch_size   = {}
+        self._voxel_budget = {}
+        self._mean_batch_size = {}
+        self._blocks       = {}
+        self._position     = {}
+
+    def prepare_manager(self, name, input_file, batch_size, color=None, voxel_budget=0):
+        '''Serve minibatches of batch_size events from a voxel cache
+
+        With a voxel_budget, minibatches are instead packed with consecutive
+        events until the next one would take the total number of voxels over
+        the budget, up to batch_size events.  Every minibatch has at least one
+        event, even one over the budget by itself.
+        '''
+
+        if not voxel_cache.is_cache(input_file):
+            raise Exception(f"{input_file} is not a voxel cache, build one with bin/build_voxel_cache.py")
+
+        self._readers[name]      = voxel_cache.reader(input_file, mmap=True)
+        self._batch_size[name]   = batch_size
+        self._voxel_budget[name] = voxel_budget
+        self._position[name]     = 0
+        # Seeded by the sample name as well, so preparing or reshuffling one sample
+        # doesn't change the block order of another, and every rank agrees on it:
+        if self._seed is None:
+            self._random[name] = numpy.random.default_rng()
+        else:
+            self._random[name] = numpy.random.default_rng([self._seed, zlib.crc32(name.encode())])
+        self._shuffle_blocks(name)
+
+        if voxel_budget > 0:
+            self._mean_batch_size[name] = self.size(name) / len(self._pack_blocks(name, 0, self.size(name)))
+        else:
+            self._mean_batch_size[name] = batch_size
+
+    def _pack_blocks(self, name, start, stop):
+        '''Split the events [start, stop) into minibatches under the voxel budget'''
+
+        reader = self._readers[name]
+        budget = self._voxel_budget[name]
+
+        # Voxels before each event:
+        cumulative = reader.offsets[::reader.n_planes]
+
+        blocks = []
+        while start < stop:
+            end = numpy.searchsorted(cumulative, cumulative[start] + budget, side='right') - 1
+            end = min(max(end, start + 1), start + self._batch_size[name], stop)
+            blocks.append((start, end))
+            start = end
+
+        return numpy.asarray(blocks, dtype=numpy.int64).reshape(-1, 2)
+
+    def _shuffle_blocks(self, name):
+
+        # The blocks are the [start, stop) events of each minibatch.  In serial
+        # access, every rank walks the file in order from its own offset.
+        # With random blocks, the start of each block is shifted by a random
+        # amount every epoch so events don't always land in the same minibatch.
+        n_events   = self._readers[name].size()
+        batch_size = self._batch_size[name]
+
+        if self._random_access_mode == 'serial_access':
+            shift = 0
+        else:
+            shift = self._random[name].integers(0, batch_size) if n_events > batch_size else 0
+
+        if self._voxel_budget[name] > 0:
+            # Pack both sides of the shift, so no minibatch wraps around the file:
+            blocks = numpy.concatenate([
+                self._pack_blocks(name, shift, n_events),
+                self._pack_blocks(name, 0, shift)])
+        else:
+            # The shifted starts wrap around, so the events before the shift are
+            # served too (the block that runs past the end wraps in fetch_minibatch_data):
+            starts = (numpy.arange(0, n_events, batch_size) + shift) % n_events
+            blocks = numpy.stack([starts, starts + batch_size], axis=-1)
+
+        if self._random_access_mode != 'serial_access':
+            self._random[name].shuffle(blocks)
+
+        self._blocks[name] = blocks[self._rank::self._world_size]
+        if len(self._blocks[name]) == 0:
+            # Fewer blocks than ranks, so ranks have to share:
+            self._blocks[name] = blocks[self._rank % len(blocks):][:1]
+
+    def mean_batch_size(self, name):
+        '''Average number of events per minibatch, which varies with a voxel budget'''
+        return self._mean_batch_size[name]
+
+    def size(self, name):
+        return self._readers[name].size()
+
+    def is_reading(self, name):
+        # Memory maps are ready immediately:
+        return False
+
+    def set_next_index(self, name, index):
+        # Start serial reading from a particular entry:
+        n_events   = self._readers[name].size()
+        batch_size = self._batch_size[name]
+        if self._voxel_budget[name] > 0:
+            blocks = self._pack_blocks(name, index, n_events)
+        else:
+            starts = numpy.arange(index, n_events, batch_size)
+            blocks = numpy.stack([starts, starts + batch_size], axis=-1)
+        self._blocks[name]   = blocks[self._rank::self._world_size]
+        self._position[name] = 0
+
+    def label_keys(self, name):
+        return self._readers[name].label_keys()
+
+    def fetch_minibatch_dims(self, name):
+        return self._readers[name].dims(self._batch_size[name])
+
+    def fetch_minibatch_data(self, name, pop=False, fetch_meta_data=False):
+
+        reader = self._readers[name]
+
+        start, stop = self._blocks[name][self._position[name]]
+
+        if stop <= reader.size():
+            return reader.read_range(start, stop)
+        else:
+            # Wrap around at the end of the file, like larcv does.
+            # This is the only case that needs a gather instead of a view.
+            return reader.read(numpy.arange(start, stop) % reader.size())
+
+    def prepare_next(self, name):
+
+        self._position[name] += 1
+        if self._position[name] >= len(self._blocks[name]):
+            self._position[name] = 0
+            self._shuffle_blocks(name)
@@ -0,0 +1,265 @@
+import os
+import json
+import shutil
+
+import numpy
+
+'''
+A compact, ragged on-disk cache of preprocessed voxels.
+
+The larcv batch fillers pad every event out to MaxVoxels with -999, and every
+transform in data_transforms has to scan that padding to strip it again.  This
+cache stores only the filled voxels, once, as a directory of plain .npy files:
+
+    meta.json      - dimension, number of planes, dtypes and label shapes
+    offsets.npy    - int64 [N_events * N_planes + 1], start of each (event, plane) in the voxel arrays
+    coords.npy     - int16 [N_voxels, dimension], voxel coordinates (x, y[, z])
+    values.npy     - float32 or float16 [N_voxels], voxel values
+    entries.npy    - int64 [N_events], larcv entry of each event
+    event_ids.npy  - larcv event ids of each event
+    <label>.npy    - float32 [N_events, N_classes], one array per label key
+
+The voxels of (event e, plane p) are coords[offsets[e*P + p] : offsets[e*P + p + 1]].
+Since everything is a .npy file, the arrays can be memory mapped and a batch of
+consecutive events is just a slice.
+'''
+
+_meta_file = "meta.json"
+_version   = 1
+
+# Coordinates are stored as int16:
+_max_coordinate = numpy.iinfo(numpy.int16).max
+
+
+def is_cache(path):
+    '''Return True if path points to a voxel cache directory'''
+    path = str(path)
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, _meta_file))
+
+
+class writer(object):
+    '''
+    Builds a voxel cache from padded larcv minibatches.
+
+    Minibatches are appended as they come out of larcv_fetcher.fetch_raw_batch.
+    The voxel arrays are streamed to disk as they arrive, so the full sample
+    never has to fit in memory.
+    '''
+
+    def __init__(self, path, dimension, value_dtype=numpy.float32):
+
+        if os.path.exists(path):
+            raise Exception(f"Voxel cache output {path} already exists")
+        os.makedirs(path)
+
+        self.path        = str(path)
+        self.dimension   = dimension
+        self.value_dtype = numpy.dtype(value_dtype)
+
+        self._n_planes = None
+        self._n_events = 0
+        self._n_voxels = 0
+        self._max_voxels = 0
+
+        self._counts    = []
+        self._entries   = []
+        self._event_ids = []
+        self._labels    = {}
+
+        self._coords_file = open(self._raw_name("coords"), 'wb')
+        self._values_file = open(self._raw_name("values"), 'wb')
+
+    def _raw_name(self, key):
+        return os.path.join(self.path, key + ".raw")
+
+    def append(self, minibatch_data, n_events=None):
+        '''Add a padded minibatch to the cache
+
+        minibatch_data is the reshaped, unconverted larcv output, with the image
+        in the [B, N_planes, Max_voxels, N_features] format.  If n_events is set,
+        only the first n_events of the minibatch are stored (to drop the events
+        larcv wraps around with at the end of a file).
+        '''
+
+        image = minibatch_data['image']
+        if n_events is None:
+            n_events = image.shape[0]
+        image = image[:n_events]
+
+        if self.dimension == 3 and image.ndim == 3:
+            # Some larcv versions drop the plane axis for 3D data:
+            image = image[:,numpy.newaxis]
+
+        if self._n_planes is None:
+            self._n_planes   = image.shape[1]
+            self._max_voxels = image.shape[2]
+
+        # One mask for the whole minibatch.  numpy.where is row-major, so the
+        # voxels come out grouped by (event, plane), which is the cache order.
+        batch_index, plane_index, voxel_index = numpy.where(image[..., -1] != -999)
+        voxels = image[batch_index, plane_index, voxel_index]
+
+        coords = voxels[:, :self.dimension]
+        if len(coords) > 0 and (coords.max() > _max_coordinate or coords.min() < 0):
+            raise Exception("Voxel coordinates do not fit in the int16 cache format")
+
+        coords.astype(numpy.int16).tofile(self._coords_file)
+        voxels[:, -1].astype(self.value_dtype).tofile(self._values_file)
+
+        counts = numpy.bincount(
+            batch_index * self._n_planes + plane_index,
+            minlength=n_events * self._n_planes)
+        self._counts.append(counts)
+        self._n_voxels += len(voxels)
+        self._n_events += n_events
+
+        self._entries.append(numpy.asarray(minibatch_data['entries'])[:n_events])
+        self._event_ids.append(numpy.asarray(minibatch_data['event_ids'])[:n_events])
+
+        for key in minibatch_data:
+            if key in ['image', 'entries', 'event_ids']:
+                continue
+            label = numpy.asarray(minibatch_data[key], dtype=numpy.float32)[:n_events]
+            self._labels.setdefault(key, []).append(label.reshape(n_events, -1))
+
+    def _finalize_npy(self, key, dtype, shape):
+        # Turn a raw stream of values into a .npy file by prepending the header:
+        header = {'descr' : numpy.lib.format.dtype_to_descr(numpy.dtype(dtype)),
+                  'fortran_order' : False,
+                  'shape' : shape}
+        with open(os.path.join(self.path, key + ".npy"), 'wb') as _out:
+            numpy.lib.format.write_array_header_2_0(_out, header)
+            with open(self._raw_name(key), 'rb') as _raw:
+                shutil.copyfileobj(_raw, _out, length=16*1024*1024)
+        os.remove(self._raw_name(key))
+
+    def finalize(self):
+
+        self._coords_file.close()
+        self._values_file.close()
+
+        self._finalize_npy("coords", numpy.int16, (self._n_voxels, self.dimension))
+        self._finalize_npy("values", self.value_dtype, (self._n_voxels,))
+
+        n_planes = self._n_planes if self._n_planes is not None else 1
+        offsets = numpy.zeros(self._n_events * n_planes + 1, dtype=numpy.int64)
+        if self._n_events > 0:
+            numpy.cumsum(numpy.concatenate(self._counts), out=offsets[1:])
+        numpy.save(os.path.join(self.path, "offsets.npy"), offsets)
+
+        def _concat(arrays, dtype):
+            if len(arrays) == 0:
+                return numpy.zeros(0, dtype=dtype)
+            return numpy.concatenate(arrays)
+
+        numpy.save(os.path.join(self.path, "entries.npy"),   _concat(self._entries, numpy.int64).astype(numpy.int64))
+        numpy.save(os.path.join(self.path, "event_ids.npy"), _concat(self._event_ids, numpy.int64))
+
+        for key in self._labels:
+            numpy.save(os.path.join(self.path, key + ".npy"), numpy.concatenate(self._labels[key]))
+
+        meta = {
+            'version'     : _version,
+            'dimension'   : self.dimension,
+            'n_planes'    : n_planes,
+            'n_events'    : self._n_events,
+            'n_voxels'    : self._n_voxels,
+            'max_voxels'  : self._max_voxels,
+            'value_dtype' : self.value_dtype.name,
+            'labels'      : { key : self._labels[key][0].shape[-1] for key in self._labels },
+        }
+        with open(os.path.join(self.path, _meta_file), 'w') as _meta:
+            json.dump(meta, _meta, indent=2)
+
+
+class reader(object):
+    '''
+    Serves minibatches out of a voxel cache.
+
+    The image comes back ragged, as a tuple (coords, values, counts) with
+    counts of shape [B, N_planes]; the ragged_* functions in data_transforms
+    turn that into network inputs without ever touching padding.
+    '''
+
+    def __init__(self, path, mmap=True):
+
+        self.path = str(path)
+
+        with open(os.path.join(self.path, _meta_file), 'r') as _meta:
+            self.meta = json.load(_meta)
+
+        if self.meta['version'] != _version:
+            raise Exception(f"Unsupported voxel cache version {self.meta['version']} in {path}")
+
+        mmap_mode = 'r' if mmap else None
+
+        def _load(key):
+            return numpy.load(os.path.join(self.path, key + ".npy"), mmap_mode=mmap_mode)
+
+        self.offsets   = numpy.load(os.path.join(self.path, "offsets.npy"))
+        self.coords    = _load("coords")
+        self.values    = _load("values")
+        self.entries   = numpy.load(os.path.join(self.path, "entries.npy"))
+        self.event_ids = numpy.load(os.path.join(self.path, "event_ids.npy"))
+        self.labels    = { key : _load(key) for key in self.meta['labels'] }
+
+        self.n_planes = self.meta['n_planes']
+
+    def size(self):
+        return self.meta['n_events']
+
+    def label_keys(self):
+        return list(self.meta['labels'].keys())
+
+    def dims(self, batch_size):
+        '''Minibatch dimensions, in the same layout larcv reports them'''
+        dims = { key : (batch_size, n_classes) for key, n_classes in self.meta['labels'].items() }
+        dims['image'] = (batch_size, self.n_planes, self.meta['max_voxels'], self.meta['dimension'] + 1)
+        return dims
+
+    def read_range(self, start, stop):
+        '''Read the consecutive events [start, stop), as views where possible'''
+
+        first = self.offsets[start * self.n_planes]
+        last  = self.offsets[stop * self.n_planes]
+
+        counts = numpy.diff(self.offsets[start * self.n_planes : stop * self.n_planes + 1])
+
+        minibatch_data = {
+            'image'     : (self.coords[first:last], self.values[first:last],
+                           counts.reshape(stop - start, self.n_planes)),
+            'entries'   : self.entries[start:stop],
+            'event_ids' : self.event_ids[start:stop],
+        }
+        for key in self.labels:
+            minibatch_data[key] = self.labels[key][start:stop]
+
+        return minibatch_data
+
+    def read(self, indexes):
+        '''Read an arbitrary list of events, in the order given'''
+
+        indexes = numpy.asarray(indexes, dtype=numpy.int64)
+
+        if len(indexes) > 0 and numpy.all(numpy.diff(indexes) == 1):
+            return self.read_range(indexes[0], indexes[-1] + 1)
+
+        # Build one gather index over all (event, plane) voxel ranges:
+        rows   = (indexes[:,numpy.newaxis] * self.n_planes + numpy.arange(self.n_planes)).ravel()
+        starts = self.offsets[rows]
+        counts = self.offsets[rows + 1] - starts
+
+        row_start = numpy.zeros(len(counts), dtype=numpy.int64)
+        numpy.cumsum(counts[:-1], out=row_start[1:])
+        gather = numpy.repeat(starts - row_start, counts) + numpy.arange(numpy.sum(counts))
+
+        minibatch_data = {
+            'image'     : (self.coords[gather], self.values[gather],
+                           counts.reshape(len(indexes), self.n_planes)),
+            'entries'   : self.entries[indexes],
+            'event_ids' : self.event_ids[indexes],
+        }
+        for key in self.labels:
+            minibatch_data[key] = self.labels[key][indexes]
+
+        return minibatch_data
@@ -0,0 +1,146 @@
+import time
+import contextlib
+from collections import OrderedDict
+
+import numpy
+
+import torch
+
+
+class phase_profiler(object):
+    '''
+    Keeps the recent history of how long each phase of a step takes.
+
+    Every phase has a ring buffer of its last `history` durations, measured
+    with a monotonic clock, and summarize() reduces them to p50 / p95 / max
+    for tensorboard.  The phases are whatever the caller records: the step
+    engine stages, plus sub phases like backward and optimizer, and the
+    logging and summary writing around a step.
+
+    The host clock only sees how long it takes to launch the kernels of a
+    phase on a GPU, so on a cuda device, device_timer() times phases with
+    CUDA events instead.  The events are read a step later, once the device
+    has caught up, so timing doesn't synchronize the host with the device.
+
+    Optionally, torch.profiler traces are recorded for `trace_steps` steps
+    starting at global step `trace_start`, and written to `trace_directory`
+    in the tensorboard plugin format.
+    '''
+
+    def __init__(self, history=1000, trace_start=-1, trace_steps=5, trace_directory=None, device=None):
+
+        self.history = history
+
+        self._buffers = OrderedDict()
+        self._counts  = OrderedDict()
+
+        # (phase, start event, end event) of the current and the previous step:
+        self._device_timing   = device is not None and device.type == 'cuda'
+        self._device_events   = []
+        self._previous_events = []
+
+        self.trace_start     = trace_start
+        self.trace_steps     = trace_steps
+        self.trace_directory = trace_directory
+        self._trace          = None
+
+    def record(self, phase, seconds):
+        if phase not in self._buffers:
+            self._buffers[phase] = numpy.zeros(self.history)
+            self._counts[phase]  = 0
+        self._buffers[phase][self._counts[phase] % self.history] = seconds
+        self._counts[phase] += 1
+
+    def record_all(self, timings):
+        '''Record a dict of {phase : seconds}, like the step engine timings'''
+        for phase in timings:
+            self.record(phase, timings[phase])
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def device_timer(self, phase):
+        '''Time the work a phase queues on a cuda device, recorded as <phase>/device
+
+        On the host, the phase timers already measure the work itself,
+        so this does nothing.
+        '''
+        if not self._device_timing:
+            yield
+            return
+        start = torch.cuda.Event(enable_timing=True)
+        end   = torch.cuda.Event(enable_timing=True)
+        start.record()
+        try:
+            yield
+        finally:
+            end.record()
+            self._device_events.append((phase, start, end))
+
+    def _read_device_events(self, events):
+        for phase, start, end in events:
+            # Normally long finished, since they were recorded a step ago:
+            end.synchronize()
+            self.record(phase + "/device", start.elapsed_time(end) / 1000.)
+
+    def summarize(self, prefix="profile/"):
+        '''Percentiles of the recorded durations of each phase, in seconds'''
+
+        summary = OrderedDict()
+        for phase in self._buffers:
+            durations = self._buffers[phase][:min(self._counts[phase], self.history)]
+            p50, p95 = numpy.percentile(durations, [50, 95])
+            summary[f"{prefix}{phase}/p50"] = p50
+            summary[f"{prefix}{phase}/p95"] = p95
+            summary[f"{prefix}{phase}/max"] = durations.max()
+        return summary
+
+    def step(self, global_step):
+        '''Call before every step, with the number of the step about to run
+
+        Reads the device timers of the step before the last one, and starts,
+        advances or stops the torch.profiler window so it covers exactly the
+        steps [trace_start, trace_start + trace_steps).
+        '''
+
+        self._read_device_events(self._previous_events)
+        self._previous_events = self._device_events
+        self._device_events   = []
+
+        if self.trace_start < 0:
+            return
+
+        if self._trace is None and global_step == self.trace_start:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._trace = torch.profiler.profile(
+                activities     = activities,
+                record_shapes  = True,
+                on_trace_ready = torch.profiler.tensorboard_trace_handler(self.trace_directory))
+            self._trace.start()
+        elif self._trace is not None:
+            if global_step >= self.trace_start + self.trace_steps:
+                self._stop_trace()
+            else:
+                self._trace.step()
+
+    def stop(self):
+        '''Close the trace window, and read any outstanding device timers'''
+        self._read_device_events(self._previous_events + self._device_events)
+        self._previous_events = []
+        self._device_events   = []
+        self._stop_trace()
+
+    def _stop_trace(self):
+        if self._trace is not None:
+            self._trace.stop()
+            self._trace = None
+            # Only trace once:
+            self.trace_start = -1
@@ -0,0 +1,140 @@
+import time
+import contextlib
+from collections import OrderedDict
+
+import torch
+
+
+class step_engine(object):
+    '''
+    Runs a single step of train, validation or inference.
+
+    A step is a fixed sequence of pluggable stages:
+
+        fetch    : sample name -> minibatch of numpy data (or None when exhausted)
+        transfer : minibatch -> minibatch of torch tensors on the compute device
+        forward  : minibatch -> logits
+        loss     : (minibatch, logits) -> scalar loss
+        update   : (minibatch, loss) -> None, backward pass and parameter update (train only)
+        metrics  : (logits, minibatch, loss) -> dict of metrics
+
+    The forward and loss stages run inside the autocast context, if one is
+    given (a function returning a context manager, like torch.autocast).
+
+    Every stage is timed with a monotonic clock, and the times are reported in
+    the metrics under "time/<stage>".  The trainers build one engine and drive
+    train, validation and inference through it, so a change to any stage
+    applies to all three.
+    '''
+
+    stages = ['fetch', 'transfer', 'forward', 'loss', 'update', 'metrics']
+
+    def __init__(self, fetch, transfer, forward, loss, metrics, update=None, lookahead=False, autocast=None):
+
+        self._stages = OrderedDict(
+            fetch    = fetch,
+            transfer = transfer,
+            forward  = forward,
+            loss     = loss,
+            update   = update,
+            metrics  = metrics,
+        )
+
+        # With lookahead, the next minibatch of a sample is fetched and its
+        # transfer started at the end of each step, to overlap with compute.
+        # This needs a transfer stage with preload() and ready().
+        self.lookahead = lookahead
+        self._pending  = {}
+
+        self._autocast = autocast
+
+        self.timings = OrderedDict()
+
+    def _timed_call(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+        return result
+
+    def _run_stage(self, stage, *args):
+        return self._timed_call(stage, self._stages[stage], *args)
+
+    def _fetch_and_transfer(self, sample, preload=False):
+
+        minibatch_data = self._run_stage('fetch', sample)
+        if minibatch_data is None:
+            return None
+
+        if preload:
+            return self._timed_call('transfer', self._stages['transfer'].preload, minibatch_data)
+        return self._run_stage('transfer', minibatch_data)
+
+    def next_minibatch(self, sample):
+        '''Fetch a minibatch and move it to the device, using the lookahead if there is one'''
+
+        if sample in self._pending:
+            minibatch_data = self._pending.pop(sample)
+            minibatch_data = self._timed_call('transfer', self._stages['transfer'].ready, minibatch_data)
+        else:
+            minibatch_data = self._fetch_and_transfer(sample)
+
+        if self.lookahead and minibatch_data is not None:
+            self._pending[sample] = self._fetch_and_transfer(sample, preload=True)
+
+        return minibatch_data
+
+    def discard_lookahead(self, sample):
+        '''Drop a preloaded minibatch, when the sample is about to be repositioned'''
+        self._pending.pop(sample, None)
+
+    def has_labels(self, minibatch_data, label_keys):
+        if isinstance(label_keys, str):
+            label_keys = [label_keys]
+        return all(key in minibatch_data for key in label_keys)
+
+    def run(self, mode, sample, label_keys):
+        '''Run one step in mode 'train', 'val' or 'inference'
+
+        Returns (minibatch_data, logits, metrics).  In inference mode, the loss
+        and metrics are only computed if the minibatch carries labels.
+        '''
+
+        if mode not in ['train', 'val', 'inference']:
+            raise Exception(f"Step engine can't handle mode {mode}")
+
+        self.timings = OrderedDict()
+
+        minibatch_data = self.next_minibatch(sample)
+        if minibatch_data is None:
+            return None, None, None
+
+        loss    = None
+        metrics = {}
+
+        if mode == 'train':
+            context = torch.enable_grad()
+        elif mode == 'val':
+            context = torch.no_grad()
+        else:
+            context = torch.inference_mode()
+
+        autocast = self._autocast() if self._autocast is not None else contextlib.nullcontext()
+
+        with context, autocast:
+
+            logits = self._run_stage('forward', minibatch_data['image'])
+
+            if mode != 'inference' or self.has_labels(minibatch_data, label_keys):
+                loss = self._run_stage('loss', minibatch_data, logits)
+
+        if mode == 'train':
+            self._run_stage('update', minibatch_data, loss)
+
+        if loss is not None:
+            with torch.inference_mode() if mode == 'inference' else torch.no_grad():
+                metrics = self._run_stage('metrics', logits, minibatch_data, loss)
+
+        for stage in self.timings:
+            metrics['time/' + stage] = self.timings[stage]
+
+        return minibatch_data, logits, metrics
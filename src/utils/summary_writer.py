@@ -0,0 +1,105 @@
+import queue
+import threading
+from collections import OrderedDict
+
+import torch
+
+# This uses tensorboardX to save summaries and metrics to tensorboard compatible files.
+import tensorboardX
+
+
+class metric_aggregator(object):
+    '''
+    Accumulates metrics across steps without leaving the device.
+
+    add() sums tensor metrics on whatever device they live on, which doesn't
+    synchronize with it.  reduce() moves all of the sums to the host in one
+    copy and returns the mean of each metric over the steps it was added in.
+    '''
+
+    def __init__(self):
+        self._sums   = OrderedDict()
+        self._counts = OrderedDict()
+
+    def add(self, metrics):
+        for key in metrics:
+            value = metrics[key]
+            if torch.is_tensor(value):
+                value = value.detach().float()
+            if key in self._sums:
+                self._sums[key] = self._sums[key] + value
+                self._counts[key] += 1
+            else:
+                self._sums[key]   = value
+                self._counts[key] = 1
+
+    def reduce(self, allreduce=None):
+        '''Return the mean of each metric, and reset
+
+        With allreduce (a function averaging a 1D tensor over all ranks), every
+        metric is packed into one flat tensor and reduced in a single
+        collective.  Every rank has to add the same keys in that case.
+        '''
+
+        keys = list(self._sums.keys())
+        tensor_keys = [ key for key in keys if torch.is_tensor(self._sums[key]) ]
+
+        if allreduce is not None and len(keys) > 0:
+            device = self._sums[tensor_keys[0]].device if len(tensor_keys) > 0 else 'cpu'
+            packed = torch.stack([ torch.as_tensor(self._sums[key], dtype=torch.float32, device=device).reshape(())
+                / self._counts[key] for key in keys ])
+            values = OrderedDict(zip(keys, allreduce(packed).cpu().tolist()))
+
+        else:
+            values = OrderedDict()
+            if len(tensor_keys) > 0:
+                # One device to host copy for every tensor metric:
+                stacked = torch.stack([ self._sums[key].reshape(()) for key in tensor_keys ]).cpu()
+                for key, value in zip(tensor_keys, stacked.tolist()):
+                    values[key] = value
+
+            for key in keys:
+                if key not in values:
+                    values[key] = float(self._sums[key])
+                values[key] /= self._counts[key]
+
+        self._sums   = OrderedDict()
+        self._counts = OrderedDict()
+
+        return values
+
+
+class summary_writer(object):
+    '''
+    A tensorboardX SummaryWriter driven from a background thread.
+
+    add_scalars() queues a dict of host values for one step and returns
+    immediately; the thread turns them into events and writes them out.
+    '''
+
+    def __init__(self, log_directory):
+
+        self._writer = tensorboardX.SummaryWriter(log_directory)
+
+        self._queue  = queue.Queue()
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def add_scalars(self, scalars, global_step):
+        self._queue.put((scalars, global_step))
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            scalars, global_step = item
+            for key in scalars:
+                self._writer.add_scalar(key, scalars[key], global_step)
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            self._writer.close()
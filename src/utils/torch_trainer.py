@@ -1,19 +1,20 @@
 import os
 import sys
 import time
+import math
+import contextlib
 from collections import OrderedDict
 
 import numpy
 
 import torch
 
-import datetime
 
 from .iocore import iocore
-
-# This uses tensorboardX to save summaries and metrics to tensorboard compatible files.
-
-import tensorboardX
+from .step_engine import step_engine
+from .profiler import phase_profiler
+from .larcvio import label_stats
+from .larcvio.larcv_fetcher import resolve_input_files
 
 class torch_trainer(iocore):
     '''
@@ -29,6 +30,20 @@ class torch_trainer(iocore):
         self._iteration       = 0.
         self._global_step     = -1.
 
+        self._engine          = None
+
+        # Position in the current round of gradient accumulation:
+        self._accumulation_step = 0
+
+        # Timing histograms of each phase of a step, and the torch.profiler window:
+        self._profiler = phase_profiler(
+            trace_start     = self.args.profile_start,
+            trace_steps     = self.args.profile_steps,
+            trace_directory = self.args.log_directory + "/profile/",
+            device          = self.get_device())
+
+        self._autocast_dtype  = None
+        self._grad_scaler     = None
 
 
 
@@ -170,10 +185,38 @@ class torch_trainer(iocore):
             cond_list.append(condition)
             func_list.append(function)
 
+        # The schedule is in epochs, and each optimizer step sees a full effective minibatch:
+        epochs_per_step = self.effective_minibatch_size() / self._train_data_size
         self.lr_calculator = lambda x: numpy.piecewise(
-            x * (self.args.minibatch_size / self._train_data_size),
-            [c(x * (self.args.minibatch_size / self._train_data_size)) for c in cond_list], func_list)
+            x * epochs_per_step,
+            [c(x * epochs_per_step) for c in cond_list], func_list)
+
+
+    def effective_minibatch_size(self):
+        '''Number of images per optimizer step, over all accumulated minibatches
+
+        With a voxel budget the minibatches vary in size, so this is the
+        average, which keeps the epoch and learning rate accounting right
+        over an epoch.
+        '''
+        return self.larcv_fetcher.mean_batch_size('primary') * self.args.accumulation_steps
+
+    def minibatch_counts(self, minibatch_data):
+        '''Number of events and of voxels (or points) in a minibatch on the device'''
+
+        keys = self.larcv_fetcher.keyword_label
+        n_events = minibatch_data[keys if isinstance(keys, str) else keys[0]].shape[0]
+
+        image = minibatch_data['image']
+        if self.args.image_mode == 'sparse':
+            # (coordinates, features, batch size):
+            n_voxels = image[1].shape[0]
+        elif self.args.image_mode == 'graph':
+            n_voxels = image.num_nodes
+        else:
+            n_voxels = None
 
+        return n_events, n_voxels
 
     def initialize(self, io_only=False):
 
@@ -191,7 +234,14 @@ class torch_trainer(iocore):
             n_trainable_parameters += numpy.prod(var.shape)
         self.print("Total number of trainable parameters in this network: {}".format(n_trainable_parameters))
 
-        self.init_optimizer()
+        if self.args.training:
+            self.init_optimizer()
+
+        self.init_loss()
+
+        self.init_precision()
+
+        self.init_engine()
 
         self.init_saver()
 
@@ -211,17 +261,6 @@ class torch_trainer(iocore):
                 self._log_keys.append('acc/{}'.format(key))
 
 
-    def get_device(self):
-        # Convert the input data to torch tensors
-        if self.args.compute_mode == "GPU":
-            device = torch.device('cuda')
-            # self.print(device)
-        else:
-            device = torch.device('cpu')
-
-
-        return device
-
     def init_optimizer(self):
 
         self.build_lr_schedule()
@@ -237,7 +276,7 @@ class torch_trainer(iocore):
         self.lr_scheduler = torch.optim.lr_scheduler.LambdaLR(self._opt, self.lr_calculator, last_epoch=-1)
 
 
-
+    def init_loss(self):
 
         device = self.get_device()
 
@@ -246,21 +285,122 @@ class torch_trainer(iocore):
         else:
             reduction = "mean"
 
-        # here we store the loss weights:
+        # here we store the loss weights, from the raw category occurences
+        # of the training sample (only needed when balancing the loss in training):
+        self._label_weights = {}
+        balance = self.args.training and self.args.balance_loss
+        if balance:
+            counts = self.label_counts()
+            self._label_weights = { key : torch.tensor(counts[key], dtype=torch.float32, device=device)
+                for key in counts }
+            for key in counts:
+                self.print(f"Class counts of {key}: {counts[key]}")
+
+        def class_weights(key):
+            if not balance:
+                return None
+            # Inverse frequency, normalized so a balanced sample has all weights 1:
+            occurences = self._label_weights[key].clamp(min=1.)
+            return occurences.sum() / (len(occurences) * occurences)
+
         if self.args.label_mode == 'all':
-            self._criterion = torch.nn.CrossEntropyLoss(reduction=reduction)
+            self._criterion = torch.nn.CrossEntropyLoss(weight=class_weights('label'), reduction=reduction)
 
 
         elif self.args.label_mode == 'split':
-            # # These are the raw category occurences
-            self._label_weights = {
-                'label_cpi'  : torch.tensor([50932., 61269.], device=device),
-                'label_prot' : torch.tensor([36583., 46790., 28828.], device=device),
-                'label_npi'  : torch.tensor([70572., 41629.], device=device),
-                'label_neut' : torch.tensor([39452., 39094., 33655.], device=device)
-            }
-            #
-            self._criterion = torch.nn.CrossEntropyLoss(reduction = reduction)
+            # One criterion per label, each with its own class weights:
+            self._criterion = { key : torch.nn.CrossEntropyLoss(weight=class_weights(key), reduction = reduction)
+                for key in self.larcv_fetcher.keyword_label }
+
+    def label_counts(self):
+        '''Class occurences of the labels of the training file(s), cached next to them'''
+        return label_stats.label_counts(resolve_input_files(self.args.file), self.args.label_mode)
+
+    def init_precision(self):
+
+        precision = self.args.precision
+
+        if precision == 'bf16':
+            self._autocast_dtype = torch.bfloat16
+        elif precision == 'fp16':
+            self._autocast_dtype = torch.float16
+        elif precision == 'fp32':
+            self._autocast_dtype = None
+        else:
+            raise Exception(f"Unknown precision {precision}")
+
+        # fp16 needs loss scaling to keep small gradients from flushing to zero.
+        # bf16 has the range of fp32, so the scaler stays disabled (a pass through):
+        self._grad_scaler = torch.amp.GradScaler(self.get_device().type,
+            enabled = precision == 'fp16' and self.args.training)
+
+    def autocast(self):
+        return torch.autocast(self.get_device().type,
+            dtype   = self._autocast_dtype,
+            enabled = self._autocast_dtype is not None)
+
+    def init_engine(self):
+
+        # One engine drives the train, validation and inference steps:
+        self._engine = step_engine(
+            fetch     = lambda sample : self.larcv_fetcher.fetch_next_batch(sample, force_pop=True),
+            transfer  = self._transfer,
+            forward   = self._forward,
+            loss      = self._calculate_loss,
+            metrics   = self._compute_metrics,
+            update    = self._update,
+            lookahead = self.args.compute_mode == "GPU",
+            autocast  = self.autocast,
+        )
+
+    def _forward(self, image):
+        # Like the host timings, only the train and inference passes are profiled:
+        if self.args.training and not self._net.training:
+            return self._net(image)
+        with self._profiler.device_timer('forward'):
+            return self._net(image)
+
+    def _update(self, minibatch_data, loss):
+
+        # Compute the gradients for the network parameters, and apply the update
+        # once every accumulation_steps minibatches.  The gradients add up over
+        # the minibatches, and each loss (a mean over its events) is weighted by
+        # its share of the events of the step.  With a voxel budget the
+        # minibatches vary in size, so the share is against the average size,
+        # which gives the mean over events rather than over minibatches:
+        accumulation_steps = self.args.accumulation_steps
+
+        if self._accumulation_step == 0:
+            self._opt.zero_grad()
+
+        n_events, _ = self.minibatch_counts(minibatch_data)
+        weight = n_events / self.effective_minibatch_size()
+
+        with self._profiler.timer('backward'), self._profiler.device_timer('backward'):
+            self._grad_scaler.scale(loss * weight).backward()
+
+        self._accumulation_step += 1
+        if self._accumulation_step < accumulation_steps:
+            return
+
+        self._accumulation_step = 0
+        with self._profiler.timer('optimizer'), self._profiler.device_timer('optimizer'):
+            scale = self._grad_scaler.get_scale() if self._grad_scaler.is_enabled() else None
+            self._step_optimizer()
+            self._grad_scaler.update()
+            # The scaler lowers the scale when it skips a step for inf/nan gradients,
+            # and then the schedule shouldn't advance either:
+            if scale is None or self._grad_scaler.get_scale() >= scale:
+                self.lr_scheduler.step()
+
+    def accumulation_context(self, final):
+        '''Context for the forward and backward pass of one accumulated minibatch'''
+        return contextlib.nullcontext()
+
+    def _step_optimizer(self):
+        # With loss scaling enabled, this unscales the gradients and
+        # skips the step if any are inf or nan:
+        self._grad_scaler.step(self._opt)
 
     def focal_loss(self, loss, logits, target, num_classes):
 
@@ -291,7 +431,7 @@ class torch_trainer(iocore):
 
 
         if self.args.label_mode == 'all':
-            values, target = torch.max(inputs[self.args.keyword_label], dim = 1)
+            values, target = torch.max(inputs[self.larcv_fetcher.keyword_label], dim = 1)
             loss = self._criterion(logits, target=target)
             if self.args.loss_mode == "focal":
                 loss = self.focal_loss(loss, logits, target, num_classes = 36)
@@ -299,7 +439,7 @@ class torch_trainer(iocore):
             loss = None
             for key in logits:
                 values, target = torch.max(inputs[key], dim=1)
-                temp_loss = self._criterion(logits[key], target = target)
+                temp_loss = self._criterion[key](logits[key], target = target)
                 if self.args.loss_mode == "focal":
                     temp_loss = self.focal_loss(temp_loss, logits[key], target, num_classes=self.num_classes[key])
 
@@ -320,7 +460,7 @@ class torch_trainer(iocore):
 
         if self.args.label_mode == 'all':
 
-            values, indices = torch.max(minibatch_data[self.args.keyword_label], dim = 1)
+            values, indices = torch.max(minibatch_data[self.larcv_fetcher.keyword_label], dim = 1)
             values, predict = torch.max(logits, dim=1)
             correct_prediction = torch.eq(predict,indices)
             accuracy = torch.mean(correct_prediction.float())
@@ -355,9 +495,9 @@ class torch_trainer(iocore):
 
     def increment_global_step(self):
 
-        previous_epoch = int((self._global_step * self.args.minibatch_size) / self._train_data_size)
+        previous_epoch = int((self._global_step * self.effective_minibatch_size()) / self._train_data_size)
         self._global_step += 1
-        current_epoch = int((self._global_step * self.args.minibatch_size) / self._train_data_size)
+        current_epoch = int((self._global_step * self.effective_minibatch_size()) / self._train_data_size)
 
         self.on_step_end()
 
@@ -370,42 +510,6 @@ class torch_trainer(iocore):
     def on_epoch_end(self):
         pass
 
-    def to_torch(self, minibatch_data, device=None):
-
-        # Convert the input data to torch tensors
-        if self.args.compute_mode == "GPU":
-            if device is None:
-                device = torch.device('cuda')
-            # print(device)
-
-        else:
-            if device is None:
-                device = torch.device('cpu')
-
-
-        for key in minibatch_data:
-            if key == 'entries' or key =='event_ids':
-                continue
-            if key == 'image' and self.args.image_mode == "sparse":
-                if self.args.input_dimension == 3:
-                    minibatch_data['image'] = (
-                            torch.tensor(minibatch_data['image'][0]).long(),
-                            torch.tensor(minibatch_data['image'][1], device=device),
-                            minibatch_data['image'][2],
-                        )
-                else:
-                    minibatch_data['image'] = (
-                            torch.tensor(minibatch_data['image'][0]).long(),
-                            torch.tensor(minibatch_data['image'][1], device=device),
-                            minibatch_data['image'][2],
-                        )
-            elif key == 'image' and self.args.image_mode == 'graph':
-                minibatch_data[key] = minibatch_data[key].to(device)
-            else:
-                minibatch_data[key] = torch.tensor(minibatch_data[key],device=device)
-
-        return minibatch_data
-
     def train_step(self):
 
 
@@ -414,78 +518,62 @@ class torch_trainer(iocore):
 
         self._net.train()
 
-        global_start_time = datetime.datetime.now()
-
-        # Reset the gradient values for this step:
-        self._opt.zero_grad()
-
-        # Fetch the next batch of data with larcv
-        io_start_time = datetime.datetime.now()
-        minibatch_data = self.larcv_fetcher.fetch_next_batch("primary",force_pop = True)
-        io_end_time = datetime.datetime.now()
-
-        minibatch_data = self.to_torch(minibatch_data)
-
-
-        # Run a forward pass of the model on the input image:
-        logits = self._net(minibatch_data['image'])
-
-        # print("Completed Forward pass")
-        # Compute the loss based on the logits
-        loss = self._calculate_loss(minibatch_data, logits)
-
-        # Compute the gradients for the network parameters:
-        loss.backward()
-        # print("Completed backward pass")
-
-        first_param = next(self._net.parameters())
-
-        # print(first_param)
-        # print(first_param.grad)
-
-        # print("First layer mean of grad ", torch.mean(torch.abs(first_param)))
-        # print("First layer mean of parameter", torch.mean(torch.abs(first_param.grad)))
-        # print("First layer mean ratio of grad to parameter", torch.mean(torch.abs(first_param.grad) / torch.abs(first_param)))
-
-        # Compute any necessary metrics:
-        metrics = self._compute_metrics(logits, minibatch_data, loss)
+        self._profiler.step(self._global_step)
 
+        global_start_time = time.perf_counter()
 
+        # One global step is one optimizer update, over accumulation_steps minibatches:
+        metrics = {}
+        n_events = 0
+        n_voxels = 0
+        for i in range(self.args.accumulation_steps):
+            with self.accumulation_context(final = i + 1 == self.args.accumulation_steps):
+                minibatch_data, logits, step_metrics = self._engine.run('train', 'primary', self.larcv_fetcher.keyword_label)
+            events, voxels = self.minibatch_counts(minibatch_data)
+            # The metrics are means over the events of a minibatch, so weight them by its events:
+            for key in step_metrics:
+                weight = 1 if key.startswith('time/') else events
+                metrics[key] = metrics.get(key, 0.0) + weight * step_metrics[key]
+            n_events += events
+            if voxels is not None:
+                n_voxels += voxels
+
+        # Report the mean of the metrics over the events, and the total of the times:
+        for key in metrics:
+            if not key.startswith('time/'):
+                metrics[key] = metrics[key] / n_events
 
         # Add the global step / second to the tensorboard log:
         try:
             metrics['global_step_per_sec'] = 1./self._seconds_per_global_step
-            metrics['images_per_second'] = self.args.minibatch_size / self._seconds_per_global_step
+            metrics['images_per_second'] = self._events_per_global_step / self._seconds_per_global_step
         except:
             metrics['global_step_per_sec'] = 0.0
             metrics['images_per_second'] = 0.0
 
-        metrics['io_fetch_time'] = (io_end_time - io_start_time).total_seconds()
-
-        # print("Calculated metrics")
-
+        # Minibatches vary in size with a voxel budget, so report what this step processed:
+        metrics['events_per_step'] = n_events
+        if self.args.image_mode != 'dense':
+            metrics['voxels_per_step'] = n_voxels
 
-        step_start_time = datetime.datetime.now()
-        # Apply the parameter update:
-        self._opt.step()
-        self.lr_scheduler.step()
+        metrics['io_fetch_time'] = metrics['time/fetch'] + metrics['time/transfer']
+        metrics['step_time']     = metrics['time/update']
 
-        # print("Updated Weights")
-        global_end_time = datetime.datetime.now()
+        self._profiler.record_all({ key[len('time/'):] : metrics[key]
+            for key in metrics if key.startswith('time/') })
 
-        metrics['step_time'] = (global_end_time - step_start_time).total_seconds()
+        with self._profiler.timer('log'):
+            self.log(metrics, saver="train")
 
+        if self._global_step % self.args.summary_iteration == 0:
+            metrics.update(self._profiler.summarize())
 
-        self.log(metrics, saver="train")
-
-        # print("Completed Log")
-
-        self.summary(metrics, saver="train")
-
-        # print("Summarized")
+        with self._profiler.timer('summary'):
+            self.summary(metrics, saver="train")
 
         # Compute global step per second:
-        self._seconds_per_global_step = (global_end_time - global_start_time).total_seconds()
+        self._seconds_per_global_step = time.perf_counter() - global_start_time
+        self._events_per_global_step  = n_events
 
         # Increment the global step value:
         self.increment_global_step()
@@ -502,50 +590,189 @@ class torch_trainer(iocore):
         # Second, validation can not occur without a validation dataloader.
         if self.args.aux_file is None: return
 
+        # A periodic sweep of the full aux file replaces the single minibatches:
+        if self.args.eval_iteration > 0:
+            return self.evaluate()
+
         # perform a validation step
-        # Validation steps can optionally accumulate over several minibatches, to
-        # fit onto a gpu or other accelerator
 
         # self._net.eval()
 
-        with torch.no_grad():
+        if self._global_step != 0 and self._global_step % self.args.aux_iteration == 0:
+
+            # (Make sure to pull from the validation set)
+            minibatch_data, logits, metrics = self._engine.run('val', 'aux', self.larcv_fetcher.keyword_label)
+
+            self.log(metrics, saver="test")
+            self.summary(metrics, saver="test")
+
+            return metrics
+
+    def n_ranks(self):
+        return 1
+
+    def rank_index(self):
+        return 0
+
+    def allreduce_sum(self, tensor):
+        '''Sum a tensor over all ranks'''
+        return tensor
+
+    def evaluate(self, force=False):
+        '''Evaluate the network on the whole aux file
+
+        Runs every eval_iteration steps (or now, with force).  The aux file is
+        read serially, and each rank sweeps its own contiguous range of the
+        entries once.  Events outside of the range, from the padding at the end
+        of the file or a minibatch straddling the range, are masked out by
+        entry number, so every event counts exactly once.  Confusion matrices
+        and the cross entropy are accumulated on the device, and reduced over
+        the ranks once at the end, to give the loss and the overall and per
+        class accuracy.
+        '''
+
+        if self.args.aux_file is None: return
+
+        if not force and (self._global_step == 0 or self._global_step % self.args.eval_iteration != 0):
+            return
+
+        start = time.perf_counter()
 
-            if self._global_step != 0 and self._global_step % self.args.aux_iteration == 0:
+        # This rank's share of the entries:
+        first = ( self.rank_index()      * self._aux_data_size) // self.n_ranks()
+        last  = ((self.rank_index() + 1) * self._aux_data_size) // self.n_ranks()
+        seen  = numpy.zeros(last - first, dtype=bool)
 
+        # A stale first minibatch is possible, after repositioning, so allow for one more:
+        max_batches = int(math.ceil((last - first) / self.args.aux_minibatch_size)) + 2
 
-                # Fetch the next batch of data with larcv
-                # (Make sure to pull from the validation set)
-                minibatch_data = self.fetch_next_batch('aux')
+        self._engine.discard_lookahead('eval')
+        self.larcv_fetcher.rewind('eval', first)
 
-                # Convert the input data to torch tensors
-                minibatch_data = self.to_torch(minibatch_data)
+        # Every rank packs the same shapes for the reduction, even with no entries:
+        device = self.get_device()
+        shapes = self.larcv_fetcher.output_shape('eval')
+        if self.args.label_mode == 'all':
+            shapes = { self.larcv_fetcher.keyword_label : shapes }
+        confusion = { key : torch.zeros(shapes[key][-1]**2, dtype=torch.int64, device=device) for key in shapes }
+        loss_sum  = torch.zeros((), dtype=torch.float64, device=device)
+
+        self._net.eval()
+
+        with torch.no_grad(), self.autocast():
+            n_batches = 0
+            while not seen.all():
+                if n_batches == max_batches:
+                    raise Exception(f"Evaluation only read {seen.sum()} of the entries {first} to {last} of the aux file")
+                n_batches += 1
+
+                minibatch_data = self._engine.next_minibatch('eval')
+
+                # Keep the first occurence of every entry of the range not yet seen:
+                entries = numpy.asarray(minibatch_data['entries']).reshape(-1).astype(numpy.int64) - first
+                keep    = (entries >= 0) & (entries < len(seen))
+                keep[keep] = ~seen[entries[keep]]
+                unique  = numpy.zeros(len(entries), dtype=bool)
+                unique[numpy.unique(numpy.where(keep, entries, -1), return_index=True)[1]] = True
+                keep &= unique
+                seen[entries[keep]] = True
+                if not keep.any():
+                    continue
 
-                # Run a forward pass of the model on the input image:
                 logits = self._net(minibatch_data['image'])
+                if self.args.label_mode == 'all':
+                    logits = { self.larcv_fetcher.keyword_label : logits }
+
+                mask = torch.from_numpy(keep).to(next(iter(logits.values())).device)
 
-                # # Here, we have to map the logit keys to aux keys
-                # for key in logits.keys():
-                #     new_key = 'aux_' + key
-                #     logits[new_key] = logits.pop(key)
+                loss = 0.
+                for key in logits:
+                    n_classes = logits[key].shape[-1]
+                    values, target  = torch.max(minibatch_data[key], dim=1)
+                    values, predict = torch.max(logits[key], dim=1)
+                    loss = loss + torch.nn.functional.cross_entropy(logits[key].float(), target, reduction='none')
+                    target, predict = target[mask], predict[mask]
+                    confusion[key] += torch.bincount(target * n_classes + predict, minlength=n_classes**2).to(device)
 
+                loss_sum += loss[mask].double().sum().to(device)
 
+        self._net.train()
 
-                # Compute the loss
-                loss = self._calculate_loss(minibatch_data, logits)
+        # One reduction of everything: the loss, the event count and the confusion matrices:
+        keys   = list(confusion.keys())
+        packed = torch.cat([ loss_sum.reshape(1), torch.tensor([float(seen.sum())], dtype=torch.float64, device=device) ]
+            + [ confusion[key].to(device=device, dtype=torch.float64) for key in keys ])
+        packed = self.allreduce_sum(packed).cpu().numpy()
 
-                # Compute the metrics for this iteration:
-                metrics = self._compute_metrics(logits, minibatch_data, loss)
+        metrics = OrderedDict()
+        metrics['eval/loss'] = packed[0] / max(packed[1], 1)
+        offset = 2
+        for key in keys:
+            n_classes = int(round(math.sqrt(len(confusion[key]))))
+            matrix = packed[offset:offset + n_classes**2].reshape(n_classes, n_classes)
+            offset += n_classes**2
 
+            # Rows are the true class, columns the prediction:
+            name = 'eval/accuracy' if self.args.label_mode == 'all' else f'eval/acc/{key}'
+            metrics[name] = numpy.trace(matrix) / max(matrix.sum(), 1)
+            per_class = numpy.diag(matrix) / numpy.maximum(matrix.sum(axis=1), 1)
+            for c in range(n_classes):
+                metrics[f'{name}/class{c}'] = per_class[c]
 
-                self.log(metrics, saver="test")
-                self.summary(metrics, saver="test")
+            self.print(f"Evaluation confusion matrix for {key} (true x predicted):\n{matrix.astype(numpy.int64)}")
 
-                return metrics
+        metrics['eval/time'] = time.perf_counter() - start
 
-    def stop(self):
-        # Mostly, this is just turning off the io:
-        # self.larcv_fetcher.stop()
-        pass
+        self.print("Evaluation at step {} over {} events: {}".format(
+            self._global_step, int(packed[1]),
+            ", ".join("{}: {:.3}".format(key, metrics[key]) for key in metrics if '/class' not in key)))
+
+        if self._aux_saver is not None:
+            self._aux_saver.add_scalars(metrics, self._global_step)
+
+        return metrics
+
+    def ana_step(self, iteration=None):
+
+        if self.args.training: return
+
+        # Set network to eval mode
+        self._net.eval()
+
+        if iteration is not None:
+            self._profiler.step(iteration)
+
+        minibatch_data, logits, metrics = self._engine.run('inference', 'primary', self.larcv_fetcher.keyword_label)
+
+        if minibatch_data is None:
+            return None
+
+        self._profiler.record_all(self._engine.timings)
+
+        if self._inference_writer is not None:
+            if self.args.label_mode == 'all':
+                logits = { self.larcv_fetcher.keyword_label : logits }
+
+            # larcv wraps around at the end of the file, so drop any repeated events:
+            n_events = min(len(minibatch_data['entries']),
+                self._inference_size - self._inference_writer.n_events)
+
+            scores = { key : torch.nn.functional.softmax(logits[key][:n_events].float(), dim=-1).cpu().numpy()
+                for key in logits }
+            self._inference_writer.write(
+                entries   = minibatch_data['entries'][:n_events],
+                event_ids = minibatch_data['event_ids'][:n_events],
+                scores    = scores)
+
+        # If the input data has labels available, log the metrics:
+        if 'loss' in metrics:
+
+            if iteration is not None:
+                metrics.update({'it.' : iteration})
+
+            self.log(metrics, saver="ana")
+
+        return metrics
 
     def checkpoint(self):
 
@@ -559,11 +786,19 @@ class torch_trainer(iocore):
 
     def batch_process(self):
 
-        # If we're not training, force the number of iterations to the epoch size or less
+        # If we're not training, the number of iterations covers the entry range,
+        # unless it was set lower on purpose (a negative number means all of it):
         if not self.args.training:
-            if self.args.iterations > int(self._train_data_size/self.args.minibatch_size) + 1:
-                self.args.iterations = int(self._train_data_size/self.args.minibatch_size) + 1
+            self._inference_size = self._train_data_size - self.args.start_index
+            if self.args.n_entries >= 0:
+                self._inference_size = min(self._inference_size, self.args.n_entries)
+            n_iterations = int(math.ceil(self._inference_size / self.args.minibatch_size))
+            if self.args.iterations < 0 or self.args.iterations > n_iterations:
+                self.args.iterations = n_iterations
                 self.print('Number of iterations set to', self.args.iterations)
+            elif self.args.iterations < n_iterations:
+                self.print(f"WARNING: {self.args.iterations} iterations of {self.args.minibatch_size} only cover "
+                           f"{self.args.iterations * self.args.minibatch_size} of the {self._inference_size} entries")
 
         start = time.time()
         # Run iterations
@@ -582,7 +817,18 @@ class torch_trainer(iocore):
 
         self.print("Total time to batch process: ", time.time() - start)
 
+        self._profiler.stop()
+        summary = self._profiler.summarize()
+        if len(summary) > 0:
+            self.print("Step phase timings (s): " + ", ".join(
+                "{}: {:.3}".format(key[len('profile/'):], summary[key]) for key in summary))
+
         if self.args.training:
+            if self.args.eval_iteration > 0:
+                self.evaluate(force=True)
+            # Make sure the last checkpoints are on disk before returning:
+            if self._checkpointer is not None:
+                self._checkpointer.wait()
             if self._saver is not None:
                 self._saver.close()
             if self._aux_saver is not None:
@@ -0,0 +1,155 @@
+import os
+import sys
+import copy
+import pathlib
+import argparse
+import tempfile
+
+import numpy
+import pytest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+torch_geometric = pytest.importorskip("torch_geometric")
+
+from src.utils.larcvio import voxel_cache
+from src.utils.distributed_trainer import distributed_trainer
+
+
+class tiny_net(torch.nn.Module):
+    '''A linear head per label on the mean of each event's points'''
+
+    def __init__(self, output_shape):
+        torch.nn.Module.__init__(self)
+        self.heads = torch.nn.ModuleDict({ key : torch.nn.Linear(4, shape[1])
+            for key, shape in output_shape.items() })
+
+    def forward(self, data):
+        features = torch.cat([data.x, data.pos / 100.], dim=1)
+        pooled   = torch_geometric.nn.global_mean_pool(features, data.batch, size=data.num_graphs)
+        return { key : head(pooled) for key, head in self.heads.items() }
+
+
+class tiny_trainer(distributed_trainer):
+
+    def init_network(self):
+        self._net = tiny_net(self.larcv_fetcher.output_shape('primary'))
+        self._net = torch.nn.parallel.DistributedDataParallel(self._net,
+            bucket_cap_mb           = self.args.ddp_bucket_mb,
+            gradient_as_bucket_view = True)
+
+
+def make_cache(path, n_events, seed=0):
+
+    rng = numpy.random.default_rng(seed)
+    writer = voxel_cache.writer(path, 3)
+    for start in range(0, n_events, 8):
+        image = numpy.full((8, 1, 40, 4), -999, dtype=numpy.float32)
+        for i in range(8):
+            n = rng.integers(1, 40)
+            image[i, 0, :n, :3] = rng.integers(0, 100, size=(n, 3))
+            image[i, 0, :n, 3]  = rng.random(size=n)
+        writer.append({
+            'image'      : image,
+            'label_neut' : numpy.eye(3)[rng.integers(0, 3, size=8)],
+            'label_cpi'  : numpy.eye(2)[rng.integers(0, 2, size=8)],
+            'entries'    : numpy.arange(start, start + 8),
+            'event_ids'  : numpy.arange(start, start + 8),
+        })
+    writer.finalize()
+
+
+def make_args(directory, **kwargs):
+    args = dict(
+        mode = 'train', training = True, distributed = True, distributed_backend = 'DDP',
+        ddp_rendezvous = os.path.join(directory, 'rendezvous'), ddp_bucket_mb = 1.0,
+        image_mode = 'graph', label_mode = 'split', input_dimension = 3, network = 'tiny',
+        io_backend = 'mmap', prefetch_depth = 0, pin_memory = False, compute_mode = 'CPU',
+        file = [pathlib.Path(directory, 'train_cache')], aux_file = pathlib.Path(directory, 'no_aux_file'), start_index = 0, n_entries = -1,
+        minibatch_size = 8, aux_minibatch_size = 8, aux_iteration = -1, eval_iteration = -1, voxel_budget = 0,
+        iterations = 1, accumulation_steps = 2, optimizer = 'Adam', learning_rate = 0.01, weight_decay = 0.0,
+        lr_schedule = 'flat', loss_mode = 'mean', balance_loss = False, precision = 'fp32', intra_op_threads = 0,
+        summary_iteration = 1, logging_iteration = 1, checkpoint_iteration = -1, shard_optimizer_state = True,
+        log_directory = os.path.join(directory, 'log'), checkpoint_directory = None,
+        profile_start = -1, profile_steps = 5)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def _train_and_restore(rank, world_size, directory, results):
+
+    os.environ['RANK']       = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+
+    trainer = tiny_trainer(make_args(directory))
+    trainer.initialize()
+
+    # Keep every minibatch the step reads, for the reference:
+    fetched = []
+    fetch   = trainer._engine._stages['fetch']
+    def record(sample):
+        minibatch_data = fetch(sample)
+        fetched.append(copy.deepcopy(minibatch_data))
+        return minibatch_data
+    trainer._engine._stages['fetch'] = record
+
+    initial = copy.deepcopy(trainer.network_module().state_dict())
+
+    # One step of two accumulated minibatches, the first one under no_sync:
+    trainer.train_step()
+    gradients = [ p.grad.detach().clone() for p in trainer.network_module().parameters() ]
+
+    # The reference: one process computing the mean loss gradient over
+    # every rank's minibatches, weighted the way the trainer weights them:
+    all_fetched = [ None ] * world_size
+    dist.all_gather_object(all_fetched, fetched)
+
+    reference = tiny_net(trainer.larcv_fetcher.output_shape('primary'))
+    reference.load_state_dict(initial)
+    for rank_fetched in all_fetched:
+        for minibatch_data in rank_fetched:
+            minibatch_data = trainer._transfer(minibatch_data)
+            n_events, _ = trainer.minibatch_counts(minibatch_data)
+            loss = trainer._calculate_loss(minibatch_data, reference(minibatch_data['image']))
+            loss = loss * n_events / trainer.effective_minibatch_size() / world_size
+            loss.backward()
+
+    results[('gradients', rank)] = all(torch.allclose(g, p.grad, atol=1e-6)
+        for g, p in zip(gradients, reference.parameters()))
+
+    # Save with the optimizer state sharded over the ranks, and restore it:
+    trainer.save_model()
+    trainer.get_checkpointer().wait()
+    dist.barrier()
+
+    state = trainer.restore_model()
+    optimizer_state = trainer._opt.state_dict()['state']
+
+    results[('restore', rank)] = (
+        state['global_step'] == trainer._global_step
+        and all(torch.equal(state['state_dict'][key], value)
+            for key, value in trainer.network_module().state_dict().items())
+        and sorted(state['optimizer']['state'].keys()) == sorted(optimizer_state.keys())
+        and all(torch.equal(state['optimizer']['state'][index]['exp_avg'], optimizer_state[index]['exp_avg'])
+            for index in optimizer_state))
+
+    trainer.stop()
+
+
+def test_ddp_accumulation_and_restore():
+
+    world_size = 2
+
+    with tempfile.TemporaryDirectory() as tmp:
+        make_cache(os.path.join(tmp, 'train_cache'), 64)
+
+        results = mp.Manager().dict()
+        mp.spawn(_train_and_restore, args=(world_size, tmp, results), nprocs=world_size)
+
+    for rank in range(world_size):
+        assert results[('gradients', rank)]
+        assert results[('restore', rank)]
@@ -0,0 +1,59 @@
+import os
+import sys
+import types
+import tempfile
+
+import pytest
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils.summary_writer import metric_aggregator
+from src.utils.distributed_trainer import distributed_trainer
+
+
+def _reduce_floats(rank, world_size, backend, init_file, results):
+
+    dist.init_process_group(backend, init_method="file://" + init_file, rank=rank, world_size=world_size)
+
+    if backend == "nccl":
+        torch.cuda.set_device(rank)
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+
+    # Just what allreduce_metrics needs from the trainer:
+    trainer = types.SimpleNamespace(
+        args               = types.SimpleNamespace(distributed_backend="DDP"),
+        world_size         = world_size,
+        _collective_device = device)
+
+    # Only python floats, like metrics already reduced on a logging step, or timings:
+    aggregator = metric_aggregator()
+    aggregator.add({'loss' : float(rank), 'time/io' : 2. * rank})
+    aggregator.add({'loss' : float(rank + 2), 'time/io' : 2. * rank})
+
+    results[rank] = dict(aggregator.reduce(distributed_trainer.allreduce_metrics(trainer)))
+
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("backend", ["gloo", "nccl"])
+def test_reduce_float_metrics(backend):
+
+    world_size = 2
+    if backend == "nccl" and (not dist.is_nccl_available() or torch.cuda.device_count() < world_size):
+        pytest.skip("nccl needs two GPUs")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = mp.Manager().dict()
+        mp.spawn(_reduce_floats, args=(world_size, backend, os.path.join(tmp, "rendezvous"), results),
+            nprocs=world_size)
+
+    # The mean over steps of each rank, then over ranks:
+    for rank in range(world_size):
+        assert results[rank]['loss']    == pytest.approx(1.5)
+        assert results[rank]['time/io'] == pytest.approx(1.0)